@@ -0,0 +1,109 @@
+"""
+Encodes stems from a `stems.StemReader` into compressed files in storage.
+All stems are encoded concurrently; each encoder process is fed straight from
+the stem's int16 buffer and its stdout is streamed into the upload.
+"""
+import io
+import json
+import logging
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+FEED_CHUNK = 1 << 20
+
+
+def sox_command(samplerate, channels, out_fmt='ogg', sox='sox'):
+    return [sox, '--multi-threaded', '-t', 's16', '-r', str(samplerate), '-c', str(channels), '-',
+            '-t', out_fmt, '-r', '44100', '-b', '16', '-c', '2', '-']
+
+
+FFMPEG_CODECS = {'ogg': ('libvorbis', 44100), 'opus': ('libopus', 48000)}
+
+
+def ffmpeg_command(samplerate, channels, out_fmt='ogg'):
+    codec, out_rate = FFMPEG_CODECS[out_fmt]
+    return ['ffmpeg', '-loglevel', 'error', '-f', 's16le', '-ar', str(samplerate), '-ac', str(channels), '-i', '-',
+            '-c:a', codec, '-ar', str(out_rate), '-ac', '2', '-f', 'ogg', '-']
+
+
+def _feed(stdin, raw):
+    view = memoryview(raw).cast('B')
+    try:
+        for start in range(0, len(view), FEED_CHUNK):
+            stdin.write(view[start:start + FEED_CHUNK])
+    except BrokenPipeError:
+        pass  # encoder died; its exit code is reported below
+    finally:
+        stdin.close()
+
+
+def encode_stem(storage, key, raw, command):
+    tic = time.time()
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=err)
+        feeder = threading.Thread(target=_feed, args=(proc.stdin, raw), daemon=True)
+        feeder.start()
+        try:
+            storage.put(key, proc.stdout)
+        except BaseException:
+            # killing the encoder breaks the feeder's pipe so it exits too
+            proc.kill()
+            proc.wait()
+            feeder.join()
+            raise
+        feeder.join()
+        if proc.wait() != 0:
+            # don't leave a truncated file behind that looks like a cache hit
+            storage.delete(key)
+            err.seek(0)
+            raise RuntimeError(f"Encoding {key} failed: {err.read().decode(errors='replace')}")
+    logger.info(f"{key} encode+upload took {time.time()-tic}")
+    return key
+
+
+def encode_stems(reader, storage, folder, command, out_fmt='ogg', names=None, executor=None):
+    """
+    Encodes `names` (default: every stem in `reader`) to `<folder>/<name>.<out_fmt>`.
+    `command(samplerate, channels)` builds the encoder argv. Returns the keys written.
+    """
+    names = names or reader.names
+    argv = command(reader.samplerate, reader.channels)
+
+    def job(name):
+        return encode_stem(storage, f'{folder}/{name}.{out_fmt}', reader.raw(name), argv)
+
+    if executor is not None:
+        return list(executor.map(job, names))
+    with ThreadPoolExecutor(max_workers=len(names)) as pool:
+        return list(pool.map(job, names))
+
+
+STATUS_NAME = 'encode_status.json'
+
+
+def _status_key(folder, run=None):
+    # one per run, so concurrent runs into one folder each wait for their own
+    return f'{folder}/encode_status-{run}.json' if run else f'{folder}/{STATUS_NAME}'
+
+
+def write_status(storage, folder, error=None, run=None):
+    """Marks an encode of `folder` finished, so waiters can tell success from failure."""
+    status = json.dumps({'ok': error is None, 'error': error}).encode()
+    storage.put(_status_key(folder, run), io.BytesIO(status))
+
+
+def read_status(storage, folder, run=None):
+    key = _status_key(folder, run)
+    if not storage.exists(key):
+        return None
+    with storage.open(key) as f:
+        return json.loads(f.read())
+
+
+def clear_status(storage, folder, run=None):
+    storage.delete(_status_key(folder, run))
@@ -0,0 +1,39 @@
+"""
+Chunk manifest for progressive results: while a track is still being
+separated, each finished window is encoded to `<folder>/chunks/<index>/<stem>.ogg`
+and listed in `<folder>/manifest.json` in time order, along with the stems
+each chunk has. They're only there for as long as the full stems aren't,
+see `clear_chunks`. A named run publishes under `run_folder`, so runs for
+other stems of the same track don't overwrite each other's chunks.
+"""
+import io
+import json
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def run_folder(folder, run=None):
+    return f'{folder}/runs/{run}' if run else folder
+
+
+def chunk_folder(folder, index):
+    return f'{folder}/chunks/{index:04d}'
+
+
+def write_manifest(storage, folder, chunks, complete, stems):
+    manifest = json.dumps({'chunks': chunks, 'complete': complete, 'stems': list(stems)}).encode()
+    storage.put(f'{folder}/{MANIFEST_NAME}', io.BytesIO(manifest))
+
+
+def read_manifest(storage, folder):
+    key = f'{folder}/{MANIFEST_NAME}'
+    if not storage.exists(key):
+        return None
+    with storage.open(key) as f:
+        return json.loads(f.read())
+
+
+def clear_chunks(storage, folder):
+    for key in storage.list(f'{folder}/chunks'):
+        storage.delete(key)
+    storage.delete(f'{folder}/{MANIFEST_NAME}')
@@ -0,0 +1,142 @@
+"""
+Uncompressed container for separated stems, written by the model handler and
+read by the encoder.
+
+    b'DMXSTEMS' | uint32 header length | JSON header | padding | stem 0 | stem 1 | ...
+
+Each stem is `length` frames of interleaved int16 samples (frames, channels),
+i.e. exactly what `sox -t s16 -c <channels> -` expects on stdin, starting at
+`header['offsets'][i]`. A stem can be consumed on its own from a ranged read
+or a memory map without touching the others.
+"""
+import io
+import json
+import struct
+import numpy as np
+
+MAGIC = b'DMXSTEMS'
+ALIGN = 64
+DTYPE = np.dtype('<i2')
+PREAMBLE = len(MAGIC) + 4
+MAX_HEADER = 4096
+# what the model separates, in its output order
+SOURCES = ['drums', 'bass', 'other', 'vocals']
+
+
+def mix_sources(name, sources=SOURCES):
+    """
+    Model sources summed into the stem `name`: the source itself, or every
+    other one for `no_<source>`, e.g. no_vocals for a karaoke track.
+    """
+    if name in sources:
+        return [name]
+    if name.startswith('no_') and name[3:] in sources:
+        return [source for source in sources if source != name[3:]]
+    raise ValueError(f"Unknown stem {name!r}")
+
+
+def _header(names, channels, length, samplerate):
+    stem_bytes = length * channels * DTYPE.itemsize
+    header = {'names': list(names), 'channels': channels, 'length': length,
+              'samplerate': samplerate, 'dtype': DTYPE.str}
+    # offsets depend on the header size, which depends on the offsets' digits: size it with room to spare
+    raw = json.dumps(dict(header, offsets=[0] * len(names))).encode()
+    data_offset = -(-(PREAMBLE + len(raw) + 16 * len(names)) // ALIGN) * ALIGN
+    header['offsets'] = [data_offset + i * stem_bytes for i in range(len(names))]
+    raw = json.dumps(header).encode()
+    assert PREAMBLE + len(raw) <= data_offset
+    return header, MAGIC + struct.pack('<I', len(raw)) + raw, data_offset + len(names) * stem_bytes
+
+
+def allocate(names, channels, length, samplerate, alloc=bytearray):
+    """
+    Returns (buf, block): the whole container as one `alloc(size)` buffer with
+    the header already written, and a (stems, length, channels) int16 view of
+    the stem data in `names` order to fill in. `alloc` can hand out e.g.
+    pinned memory; it only needs to support the buffer protocol.
+    """
+    header, preamble, total = _header(names, channels, length, samplerate)
+    buf = alloc(total)
+    memoryview(buf).cast('B')[:len(preamble)] = preamble
+    # stems are laid out back to back, so one array covers them all
+    block = np.frombuffer(buf, DTYPE, len(names) * length * channels, header['offsets'][0])
+    return buf, block.reshape(len(names), length, channels)
+
+
+def pack(stems, samplerate):
+    """`stems`: dict of name -> (channels, length) int16 arrays. Returns the container as a bytearray."""
+    channels, length = next(iter(stems.values())).shape
+    buf, block = allocate(list(stems), channels, length, samplerate)
+    for view, stem in zip(block, stems.values()):
+        view[:] = stem.T
+    return buf
+
+
+class BufferReader(io.RawIOBase):
+    """File-like view over a buffer, so uploads don't copy it into a BytesIO."""
+    def __init__(self, buf):
+        self.view = memoryview(buf).cast('B')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: len(self.view)}[whence]
+        self.pos = max(0, base + pos)
+        return self.pos
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.view) - self.pos))
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+class StemReader:
+    """
+    Reads stems one at a time through `read_range(start, size) -> bytes`,
+    e.g. a ranged GET against storage, or zero-copy from a buffer/memory map.
+    """
+    def __init__(self, read_range):
+        self.read_range = read_range
+        head = read_range(0, MAX_HEADER)
+        if head[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a stems container")
+        (size,) = struct.unpack('<I', head[len(MAGIC):PREAMBLE])
+        if PREAMBLE + size > len(head):
+            head = read_range(0, PREAMBLE + size)
+        self.header = json.loads(bytes(head[PREAMBLE:PREAMBLE + size]))
+        self.names = self.header['names']
+        self.channels = self.header['channels']
+        self.length = self.header['length']
+        self.samplerate = self.header['samplerate']
+        self.stem_bytes = self.length * self.channels * DTYPE.itemsize
+
+    @classmethod
+    def from_buffer(cls, buf):
+        view = memoryview(buf).cast('B')
+        return cls(lambda start, size: view[start:start + size])
+
+    @classmethod
+    def from_file(cls, path):
+        return cls.from_buffer(np.memmap(path, np.uint8, 'r'))
+
+    @classmethod
+    def from_storage(cls, storage, key):
+        return cls(lambda start, size: storage.read_range(key, start, size))
+
+    def raw(self, name):
+        """Interleaved int16 bytes of one stem."""
+        offset = self.header['offsets'][self.names.index(name)]
+        return self.read_range(offset, self.stem_bytes)
+
+    def stem(self, name):
+        """(length, channels) int16 array of one stem."""
+        return np.frombuffer(self.raw(name), DTYPE).reshape(self.length, self.channels)
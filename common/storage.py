@@ -0,0 +1,271 @@
+"""
+Object storage shared by the flask app, the model handler and the encode function.
+
+`open_storage(bucket)` picks the backend from the environment:
+    DEMUXR_STORAGE_ROOT   keep objects under <root>/<bucket> on disk instead of S3
+    DEMUXR_STORAGE_URL    URL prefix files are served under (filesystem backend)
+    DEMUXR_CACHE_DIR      put a local LRU disk cache in front of the backend
+    DEMUXR_CACHE_BYTES    size bound of that cache (default 2 GiB)
+"""
+import functools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Storage:
+    def exists(self, key):
+        raise NotImplementedError
+
+    def open(self, key):
+        """Readable binary stream of the object; the caller closes it."""
+        raise NotImplementedError
+
+    def put(self, key, fileobj):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def list(self, folder):
+        """Keys of every object under `folder`."""
+        raise NotImplementedError
+
+    def url(self, key, expires=60):
+        raise NotImplementedError
+
+    def read_range(self, key, start, size):
+        with self.open(key) as f:
+            f.seek(start)
+            return f.read(size)
+
+    def download(self, key, fileobj):
+        with self.open(key) as src:
+            shutil.copyfileobj(src, fileobj, 1 << 20)
+
+
+class S3Storage(Storage):
+    def __init__(self, bucket, client=None):
+        import boto3
+        self.bucket = bucket
+        self.client = client or boto3.client('s3')
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return False
+        return True
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def read_range(self, key, start, size):
+        byte_range = f'bytes={start}-{start + size - 1}'
+        return self.client.get_object(Bucket=self.bucket, Key=key, Range=byte_range)['Body'].read()
+
+    def put(self, key, fileobj):
+        self.client.upload_fileobj(fileobj, self.bucket, key)
+
+    def download(self, key, fileobj):
+        self.client.download_fileobj(self.bucket, key, fileobj)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def list(self, folder):
+        pages = self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=folder + '/')
+        return [obj['Key'] for page in pages for obj in page.get('Contents', [])]
+
+    def url(self, key, expires=60):
+        return self.client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={'Bucket': self.bucket, 'Key': key},
+            ExpiresIn=expires)
+
+
+class FileStorage(Storage):
+    """Objects as plain files under `root`. Stand-in for S3 in tests and single-box deploys."""
+    def __init__(self, root, base_url=None):
+        self.root = root
+        self.base_url = base_url
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        parts = key.split('/')
+        if key.startswith('/') or '..' in parts:
+            raise ValueError(f"Key {key!r} points outside the storage root")
+        return os.path.join(self.root, *parts)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    @contextmanager
+    def writer(self, key):
+        """Write-then-rename so readers never see a partial object."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', suffix='.part', delete=False)
+        try:
+            with tmp:
+                yield tmp
+            os.replace(tmp.name, path)
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+
+    def put(self, key, fileobj):
+        with self.writer(key) as f:
+            shutil.copyfileobj(fileobj, f, 1 << 20)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, folder):
+        keys = []
+        for dirpath, _, names in os.walk(self.path(folder)):
+            prefix = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            keys.extend(f'{prefix}/{name}' for name in names if not name.startswith('.'))
+        return keys
+
+    def url(self, key, expires=60):
+        if self.base_url is None:
+            return 'file://' + self.path(key)
+        return self.base_url.rstrip('/') + '/' + key
+
+
+class _Tee:
+    """Readable stream that copies everything read from `src` into `dst`."""
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.dst.write(data)
+        return data
+
+
+class CachedStorage(Storage):
+    """
+    Size-bounded LRU disk cache in front of another backend. Reads are filled
+    from the backend on miss; writes go through to the backend and are kept
+    locally, so a container sharing `cache_dir` reads them without a round trip.
+    Recency is the file mtime, so several processes can share one directory.
+    Each process counts what it adds and only walks the directory to evict once
+    that count passes `max_bytes`, so the bound is per process between walks.
+    """
+    def __init__(self, backend, cache_dir, max_bytes=2 << 30):
+        self.backend = backend
+        self.local = FileStorage(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = None  # bytes in the cache as of the last walk, plus what was added since
+
+    def _touch(self, key):
+        try:
+            os.utime(self.local.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def exists(self, key):
+        if self._touch(key):
+            return True
+        return self.backend.exists(key)
+
+    def open(self, key):
+        if not self._touch(key):
+            logger.info(f"{key} not in local cache, fetching")
+            with self.local.writer(key) as f:
+                self.backend.download(key, f)
+                added = f.tell()
+            self._added(added)
+        return self.local.open(key)
+
+    def read_range(self, key, start, size):
+        if self._touch(key):
+            return self.local.read_range(key, start, size)
+        return self.backend.read_range(key, start, size)
+
+    def put(self, key, fileobj):
+        # Only shows up in the cache once the backend has it, so `exists` never
+        # promises an object other containers can't read yet. The upload reads
+        # through a tee, so a stream (e.g. encoder output) is never spooled first
+        with self.local.writer(key) as f:
+            self.backend.put(key, _Tee(fileobj, f))
+            shutil.copyfileobj(fileobj, f, 1 << 20)  # whatever the backend left unread
+            added = f.tell()
+        self._added(added)
+
+    def delete(self, key):
+        try:
+            removed = os.path.getsize(self.local.path(key))
+        except FileNotFoundError:
+            removed = 0
+        self.local.delete(key)
+        self.backend.delete(key)
+        self._added(-removed)
+
+    def list(self, folder):
+        return self.backend.list(folder)
+
+    def url(self, key, expires=60):
+        return self.backend.url(key, expires)
+
+    def _added(self, nbytes):
+        with self.lock:
+            if self.size is not None and self.size + nbytes <= self.max_bytes:
+                self.size += nbytes
+                return
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            files = []
+            for dirpath, _, names in os.walk(self.local.root):
+                for name in names:
+                    if name.startswith('.'):
+                        continue  # in-flight writes
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+            total = sum(f[1] for f in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self.size = total
+
+
+@functools.lru_cache()
+def open_storage(bucket):
+    root = os.environ.get('DEMUXR_STORAGE_ROOT')
+    if root:
+        storage = FileStorage(os.path.join(root, bucket), os.environ.get('DEMUXR_STORAGE_URL'))
+    else:
+        storage = S3Storage(bucket)
+    cache_dir = os.environ.get('DEMUXR_CACHE_DIR')
+    if cache_dir:
+        max_bytes = int(os.environ.get('DEMUXR_CACHE_BYTES', 2 << 30))
+        storage = CachedStorage(storage, os.path.join(cache_dir, bucket), max_bytes)
+    return storage
@@ -1,50 +1,46 @@
+"""
+Deployed with storage.py, stems.py and encoder.py from common/ next to this
+file. They log through the standard library and need only numpy and boto3
+from the function's layers.
+"""
 import json
+import logging
 import os
-import io, boto3, subprocess, numpy as np
+import functools
 import time
+from storage import open_storage
+from stems import StemReader
+from encoder import encode_stems, sox_command
 
-s3 = boto3.client("s3")
+logging.getLogger().setLevel(logging.INFO)
 
-def encode(bucket, object_name, out_fmt='ogg'):
-    blob = io.BytesIO()
+
+def log_metric(trace_id, stage, seconds, **fields):
+    print(json.dumps(dict(trace_id=trace_id, stage=stage, seconds=seconds, **fields)))
+
+
+def encode(bucket, object_name, out_fmt='ogg', trace_id=None):
+    storage = open_storage(bucket)
     tic = time.time()
-    s3.download_fileobj(bucket, object_name, blob)
-    blob.seek(0)
-    print("Blob download: ", time.time()-tic)
-    
+    reader = StemReader.from_storage(storage, object_name)
+    log_metric(trace_id, 'header_load', time.time()-tic)
+
+    folder = object_name.rsplit("/", 1)[0]
+    command = functools.partial(sox_command, out_fmt=out_fmt, sox='/opt/bin/sox')
     tic = time.time()
-    npz = np.load(blob)
-    del blob
-    print("Blob load: ", time.time()-tic)
-
-    samplerate = int(npz['samplerate'])
-    cmd = f"/opt/bin/sox --multi-threaded -t s16 -r {samplerate} -c 2 - -t {out_fmt} -r 44100 -b 16 -c 2 -"
-    cmd_a = cmd.split(' ')
-    source_names = ["drums", "bass", "other", "vocals"]
-    folder = object_name.split("/")[0]
-    
-    for name in source_names:
-        key = folder + '/' + name + '.' + out_fmt
-        array = npz[name]
-        tic = time.time()
-        handle = subprocess.Popen(cmd_a, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = handle.communicate(array.tobytes(order='F'))
-        buf = io.BytesIO(out)
-        print(name, " encode: ", time.time()-tic)
-        
-        print("Uploading ", name, " to ", bucket, "/", key)
-        tic = time.time()
-        s3.upload_fileobj(buf, bucket, key)
-        print(name, " upload: ", time.time()-tic)
-    
+    keys = encode_stems(reader, storage, folder, command, out_fmt)
+    log_metric(trace_id, 'encode', time.time()-tic, keys=keys,
+               audio_seconds=reader.length / reader.samplerate,
+               bytes_read=reader.stem_bytes * len(reader.names))
+
     return True
-        
-        
-        
+
+
+
 def lambda_handler(event, context):
     is_done = False
-    is_done = encode(event['bucket'], event['object'])
-    
+    is_done = encode(event['bucket'], event['object'], trace_id=event.get('trace_id'))
+
     return {
         'statusCode': 200,
         'isDone': is_done
@@ -1,21 +1,72 @@
-from flask import Flask, request
-from werkzeug.utils import secure_filename
+from flask import Flask, request, abort, send_file
+from werkzeug.utils import secure_filename, safe_join
 import requests
 from flask_cors import CORS
 from loguru import logger
 import subprocess, io
 import json
 import hashlib
+import logging
+import shutil
+import sys
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import boto3
 from botocore.config import Config
-from botocore.exceptions import ClientError
+import os
+from jobs import JobQueue
+from scheduler import Scheduler, Overloaded
+import fingerprint
+import ingest
+from storage import open_storage
+from encoder import read_status, clear_status
+from progressive import chunk_folder, run_folder, read_manifest, clear_chunks
+from stems import SOURCES, mix_sources
+from metrics import STAGE_SECONDS, CACHE_LOOKUPS, BYTES
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+import time
 
 app = Flask(__name__)
 CORS(app)
 
+logger.configure(extra={'trace_id': '-'})
+logger.remove()
+logger.add(sys.stderr, format="{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {extra[trace_id]} | {name}:{function}:{line} - {message}")
+# storage.py and encoder.py log through the standard library
+logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)-8s | - | %(name)s:%(funcName)s:%(lineno)d - %(message)s")
+
 BUCKET = "demucs-app-cache"
+# jobs waiting for the model hold a worker, so keep this well above DEMUXR_INFERENCE_SLOTS
+job_queue = JobQueue(max_workers=int(os.environ.get('DEMUXR_JOB_WORKERS', 16)))
+# tracks in flight at the model server: 2 workers x batchSize 4 in model/config.properties
+scheduler = Scheduler(slots=int(os.environ.get('DEMUXR_INFERENCE_SLOTS', 8)),
+                      budget=float(os.environ.get('DEMUXR_BACKLOG_SECONDS', 1800)),
+                      rtf=float(os.environ.get('DEMUXR_RTF', 0.2)))
 lambda_client = boto3.client('lambda', region_name='us-east-1', config=Config(read_timeout=180))
-s3_client = boto3.client('s3')
+storage = open_storage(BUCKET)
+# Uploads and conversions are streamed through temp files that stay in memory up to this size
+SPOOL_BYTES = int(os.environ.get('DEMUXR_SPOOL_BYTES', 1 << 20))
+CHUNK = 1 << 20
+# 128 kbit/s, for guessing a track's duration from its size
+BYTES_PER_SECOND = 16000
+# Also key the cache by an audio fingerprint, so re-encodes of a cached track reuse its stems
+FINGERPRINT = os.environ.get('DEMUXR_FINGERPRINT', '0') == '1'
+fingerprints = fingerprint.Index(storage) if FINGERPRINT else None
+# Links are resolved by this downloader, at most DEMUXR_DOWNLOAD_WORKERS at once
+downloader = ingest.open_downloader()
+download_pool = ThreadPoolExecutor(int(os.environ.get('DEMUXR_DOWNLOAD_WORKERS', 4)), thread_name_prefix='download')
+# New links are priced at this many seconds until their job has probed them
+LINK_SECONDS = float(os.environ.get('DEMUXR_LINK_SECONDS', 300))
+# Model time of a preview relative to a full run, for scheduling it, from the preview settings of the model
+# server (model/handler.py): fewer segments for the smaller overlap, and half as many at the native rate
+PREVIEW_OVERLAP = float(os.environ.get('DEMUXR_PREVIEW_OVERLAP', 0.1))
+PREVIEW_NATIVE_RATE = os.environ.get('DEMUXR_PREVIEW_NATIVE_RATE', '1') == '1'
+PREVIEW_COST = (1 - 0.25) / (1 - PREVIEW_OVERLAP) * (0.5 if PREVIEW_NATIVE_RATE else 1)
+# Previews are stored here under the track's folder until the full run replaces them
+PREVIEW_FOLDER = 'preview'
 
 
 @app.route("/")
@@ -23,106 +74,464 @@ def index():
     return "Demuxr is running"
     
 
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    return {'error': str(e), 'retry_after': e.retry_after}, 429, {'Retry-After': str(int(e.retry_after) + 1)}
+
+
 @app.route("/file_upload", methods=['POST'])
 def file_upload():
-    # Receive audio file
-    file = request.files['file']
+    # Receive audio file and block until it is demuxed
+    job = submit_upload(request.files['file'], request.headers.get('X-Request-ID'), requested_stems(),
+                        requested_preview())
+    job.done.wait()
+    if job.error:
+        raise RuntimeError(job.error)
+    return job.result
+
+
+@app.route("/jobs", methods=['POST'])
+def job_submit():
+    job = submit_upload(request.files['file'], request.headers.get('X-Request-ID'), requested_stems(),
+                        requested_preview())
+    return {'job_id': job.id, 'trace_id': job.trace_id}, 202
+
+
+@app.route("/links", methods=['POST'])
+def link_submit():
+    url = request.form.get('url') or request.args.get('url')
+    if not url:
+        abort(400, "No url given")
+    job = submit_link(url, request.headers.get('X-Request-ID'), requested_stems(), requested_preview())
+    return {'job_id': job.id, 'trace_id': job.trace_id}, 202
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    status = job.to_dict()
+    if job.ticket and not job.done.is_set():
+        status['queue'] = scheduler.status(job.ticket)
+    if job.folder and job.run and not job.done.is_set():
+        status['chunks'] = progressive_urls(job.folder, job.run)
+    if job.preview and not job.done.is_set():
+        status['preview'] = job.preview
+    return status
+
+
+@app.route("/metrics")
+def metrics():
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+
+@app.route("/files/<path:key>")
+def serve_file(key):
+    # only used when DEMUXR_STORAGE_ROOT keeps the cache on local disk
+    root = os.environ.get('DEMUXR_STORAGE_ROOT')
+    if not root or '..' in key.split('/') or safe_join(os.path.join(root, BUCKET), key) is None:
+        abort(404)
+    if not storage.exists(key):
+        abort(404)
+    return send_file(storage.open(key), mimetype='audio/ogg')
+
+
+def requested_stems():
+    """
+    The `stems` form field: comma-separated sources and `no_<source>` mixes,
+    e.g. `no_vocals` for karaoke. Every source if not given.
+    """
+    value = request.form.get('stems') or request.args.get('stems')
+    if not value:
+        return SOURCES
+    stems = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    try:
+        for name in stems:
+            mix_sources(name)
+    except ValueError as e:
+        abort(400, str(e))
+    return stems
+
+
+def requested_preview():
+    """
+    `quality=preview` separates the track quickly at lower quality first and
+    reports those stems under the job's `preview` while the full run goes on.
+    """
+    quality = request.form.get('quality') or request.args.get('quality') or 'full'
+    if quality not in ('full', 'preview'):
+        abort(400, f"Unknown quality {quality!r}")
+    return quality == 'preview'
+
+
+def missing_stems(folder, stems):
+    return [stem for stem in stems if not storage.exists(f'{folder}/{stem}.ogg')]
+
+
+def submit_upload(file, trace_id=None, stems=SOURCES, preview=False):
+    # the upload stream is closed with the request, so spool it out first, hashing as it goes
     filetype = file.filename.split('.')[-1]
-    input_hash = hashlib.md5(file.read()).hexdigest()
-    if filetype != 'ogg':
-        file = convert_to_ogg(file)
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    md5 = hashlib.md5()
+    for chunk in iter(lambda: file.stream.read(CHUNK), b''):
+        md5.update(chunk)
+        spool.write(chunk)
+    BYTES.labels('upload').inc(spool.tell())
+    input_hash = md5.hexdigest()
+    seconds = None
+    if missing_stems(input_hash, stems):
+        # sized from the upload's size for now; the job probes the real duration, see process_upload
+        seconds = spool.tell() / BYTES_PER_SECOND
+    # concurrent uploads of the same track asking for the same stems share one job
+    key = input_hash + ':' + ','.join(sorted(stems))
+    return submit_job(process_upload, spool, input_hash, filetype, stems, preview, key=key, trace_id=trace_id,
+                      seconds=seconds)
+
+
+def submit_link(url, trace_id=None, stems=SOURCES, preview=False):
+    source_id = downloader.source_id(url)
+    if source_id is None:
+        abort(400, f"Unsupported link {url!r}")
+    entry = ingest.lookup(storage, downloader.kind, source_id)
+    seconds = None
+    if entry:
+        if missing_stems(entry['file_hash'], stems):
+            seconds = entry['seconds']
+    else:
+        # priced at a typical length for now; the job probes the real one, see process_link
+        seconds = LINK_SECONDS
+    # concurrent requests for the same source and stems share one job, and one download
+    key = f'{downloader.kind}:{source_id}:' + ','.join(sorted(stems))
+    return submit_job(process_link, source_id, stems, preview, key=key, trace_id=trace_id, seconds=seconds)
+
+
+def submit_job(fn, *args, key, trace_id=None, seconds=None):
+    """
+    Queues `fn(job, *args)`, or returns the job already running for `key`.
+    A new job that needs the model for `seconds` of audio gets a ticket
+    first, so the request is turned away here, before a job exists, if the
+    backlog is full. Requests joining a running job are never priced.
+    """
+    job = job_queue.running(key)
+    if job:
+        logger.info(f"Coalescing {key} into job {job.id}")
+        return job
+    ticket = scheduler.reserve(client_id(), seconds) if seconds is not None else None
+    job = job_queue.submit(fn, *args, key=key, trace_id=trace_id, ticket=ticket)
+    if ticket and job.ticket is not ticket:
+        scheduler.finish(ticket, measure=False)  # another request started the job meanwhile
+    return job
+
+
+def client_id():
+    # nginx appends the peer address it saw, which the client can't forge
+    forwarded = request.headers.get('X-Forwarded-For')
+    return forwarded.split(',')[-1].strip() if forwarded else request.remote_addr
+
+
+@contextmanager
+def job_stage(job, name, progress):
+    """Reports `name` as the job's stage and times it into the stage histogram."""
+    if job:
+        job.update(name, progress)
+    with STAGE_SECONDS.labels(name).time():
+        yield
+
+
+def process_upload(job, file, input_hash, filetype, stems=SOURCES, preview=False):
+    try:
+        if job.ticket:
+            scheduler.update(job.ticket, probe_duration(file))
+        return _process_upload(job, file, input_hash, filetype, stems, preview)
+    finally:
+        if job.ticket:
+            # frees its place if the job never got as far as the model
+            scheduler.finish(job.ticket, measure=False)
+
+
+def _process_upload(job, file, input_hash, filetype, stems, preview):
+    with file:
+        words = None
+        # a byte-identical upload is found by its hash alone
+        if fingerprints and not storage.exists(input_hash + '/original.ogg'):
+            with job_stage(job, 'fingerprinting', 0.02):
+                words, weak, seconds = fingerprint_upload(file)
+                match = fingerprints.find_match(words, weak, seconds)
+            # only trust a match that was actually separated; stems it lacks are separated from its original
+            if match and storage.exists(match + '/original.ogg'):
+                logger.info(f"{input_hash} sounds like {match}, reusing its stems")
+                CACHE_LOOKUPS.labels('fingerprint').inc()
+                return main(file, match, job, stems, preview)
+        if filetype != 'ogg':
+            with job_stage(job, 'converting', 0.05):
+                file.seek(0)
+                converted = convert_to_ogg(file)
+            file.close()
+            file = converted
         file.seek(0)
-    demuxed_urls = main(file, input_hash)        
-    return demuxed_urls
+        result = main(file, input_hash, job, stems, preview)
+        if words is not None:
+            fingerprints.record(words, seconds, input_hash)
+        return result
+
+
+def process_link(job, source_id, stems=SOURCES, preview=False):
+    try:
+        return _process_link(job, source_id, stems, preview)
+    finally:
+        if job.ticket:
+            scheduler.finish(job.ticket, measure=False)
+
+
+def _process_link(job, source_id, stems, preview):
+    kind = downloader.kind
+    entry = ingest.lookup(storage, kind, source_id)
+    if entry and storage.exists(entry['file_hash'] + '/original.ogg'):
+        logger.info(f"{kind} source {source_id} is cached as {entry['file_hash']}")
+        CACHE_LOOKUPS.labels('source').inc()
+        return main(None, entry['file_hash'], job, stems, preview)
+    with tempfile.TemporaryDirectory() as temp:
+        with job_stage(job, 'downloading', 0.01):
+            if job.ticket and not entry:
+                # the real duration from the metadata, before the download takes its time
+                scheduler.update(job.ticket, download_pool.submit(downloader.probe, source_id).result())
+            path = download_pool.submit(downloader.download, source_id, temp).result()
+        BYTES.labels('download').inc(os.path.getsize(path))
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK), b''):
+                md5.update(chunk)
+        file = open(path, 'rb')
+        seconds = probe_duration(file)
+        if job.ticket:
+            scheduler.update(job.ticket, seconds)
+        result = _process_upload(job, file, md5.hexdigest(), path.split('.')[-1], stems, preview)
+    # the folder main() used, which may be a fingerprint match's
+    ingest.record(storage, kind, source_id, job.folder, seconds)
+    return result
+
+
+def _pump(src, dst):
+    try:
+        shutil.copyfileobj(src, dst, CHUNK)
+    except BrokenPipeError:
+        pass  # ffmpeg died; its exit code is reported by transcode
+    finally:
+        dst.close()
+
+
+def transcode(command, file, dst):
+    """Streams `file` through ffmpeg `command` into `dst`, never holding either whole in memory."""
+    with tempfile.TemporaryFile() as err:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=err)
+        feeder = threading.Thread(target=_pump, args=(file, process.stdin), daemon=True)
+        feeder.start()
+        shutil.copyfileobj(process.stdout, dst, CHUNK)
+        feeder.join()
+        if process.wait() != 0:
+            err.seek(0)
+            raise RuntimeError(f"{command[0]} failed: {err.read().decode(errors='replace')}")
 
 
 def convert_to_ogg(file):
     logger.info("converting to OGG...")
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-i', '-', '-c:a', 'libvorbis', '-f', 'ogg', '-']
+    ogg = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    try:
+        transcode(command, file, ogg)
+    except Exception:
+        ogg.close()
+        raise
+    return ogg
+
+
+def probe_duration(file):
+    """Track length in seconds as ffprobe reads it, or estimated from its size."""
+    file.seek(0)
+    out = io.BytesIO()
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', '-i', '-']
+    try:
+        transcode(command, file, out)
+        return float(out.getvalue())
+    except (RuntimeError, ValueError):
+        return file.seek(0, io.SEEK_END) / BYTES_PER_SECOND
+
+
+def fingerprint_upload(file):
     file.seek(0)
-    command = ['ffmpeg', '-y', '-i', '-', '-c:a', 'libvorbis', '-f', 'ogg', '-']
-    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    ogg, err = process.communicate(file.read())
-    return io.BytesIO(ogg)
+    sink = fingerprint.Fingerprinter()
+    transcode(fingerprint.PCM_COMMAND, file, sink)
+    return sink.result()
     
     
-def rip_from_youtube(url):
-    # happy easter
-    import youtube_dl
-    import os
-    import tempfile
+def main(file, file_hash, job=None, stems=SOURCES, preview=False):
+    """
+    Separates `stems` of the track in `file_hash`, only running the model for
+    those not already in the cache, e.g. vocals after an earlier no_vocals.
+    With `preview`, a quick low quality run comes first and its stems are set
+    as the job's preview; the full run then replaces them.
+    """
+    trace_id = job.trace_id if job else uuid.uuid4().hex
+    status = 200
+    if job:
+        job.folder = file_hash
+    missing = missing_stems(file_hash, stems)
+    CACHE_LOOKUPS.labels('miss' if missing else 'hit').inc()
+    if missing:
+        logger.info(f"{file_hash} stems {missing} not found in cache")
+        if not storage.exists(file_hash + '/original.ogg'):
+            logger.info("Uploading audio file to S3 cache...")
+            with job_stage(job, 'uploading', 0.1):
+                BYTES.labels('original').inc(file.seek(0, io.SEEK_END))
+                file.seek(0)
+                storage.put(file_hash + '/original.ogg', file)
+        ticket = job.ticket if job else None
+        if ticket is None:
+            ticket = scheduler.reserve('-', probe_duration(file), admit=False)
+            if job:
+                job.ticket = ticket
+        if preview:
+            run_preview(file_hash, stems, missing, ticket, job, trace_id)
+        status = separate(file_hash, missing, ticket, job, trace_id)
+        if preview:
+            clear_preview(file_hash, missing)
+        logger.info("Returning demuxed urls...")
+    return {'stem_urls': s3_presigned_urls(file_hash, stems), 'status': status}
 
-    with tempfile.TemporaryDirectory() as temp:
-        ydl_opts = {
-        'quiet':True,
-        'outtmpl':f'{temp}/%(id)s/original.%(ext)s',
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'vorbis',
-            'preferredquality': '128',}],
-            'postprocessor_args': ['-ar', '44100'],
-        }
-
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        info_dict = ydl.extract_info(url, download=True)
-    audio_path = os.path.join(temp, info_dict['id'], 'original.ogg')
-    file = io.BytesIO(open(audio_path, 'rb'))
-    file_hash = hashlib.md5(file.read()).hexdigest()
-    file.seek(0)
-    demuxed_urls = main(file, file_hash)
-    return demuxed_urls
 
+STAGES = {
+    'full': [('waiting', 0.15), ('separating', 0.2), ('encoding', 0.8)],
+    'preview': [('preview_waiting', 0.11), ('previewing', 0.12), ('preview_encoding', 0.14)],
+}
 
-def main(file, file_hash):
+
+def separate(file_hash, stems, ticket, job=None, trace_id=None, quality='full'):
+    """Runs `stems` of the track through the model once `ticket` is up and waits for them to be encoded."""
+    folder = file_hash if quality == 'full' else f'{file_hash}/{PREVIEW_FOLDER}'
+    # another job may be separating other stems of the track into the same folder meanwhile
+    run = uuid.uuid4().hex
+    if job and quality == 'full':
+        job.run = run
+    (waiting, p_waiting), (separating, p_separating), (encoding, p_encoding) = STAGES[quality]
     status = 200
-    if not s3_exists(file_hash + '/vocals.ogg'):
-        logger.info("Uploading audio file to S3 cache...")
-        s3_client.upload_fileobj(file, BUCKET, file_hash + '/original.ogg')
-        logger.info("Running inference on uploaded audio...")
-        run_inference(file_hash + '/original.ogg')
-        logger.info("Encoding inferenced npz output...")
-        encode_resp = run_encode(BUCKET, file_hash + '/model_output.npz')
-        logger.info("Returning demuxed urls...")
-        status = encode_resp['StatusCode']
-    return {'stem_urls': s3_presigned_urls(file_hash), 'status': status}
-    
+    with job_stage(job, waiting, p_waiting):
+        scheduler.wait(ticket)
+    logger.info(f"Running {quality} inference on uploaded audio...")
+    with job_stage(job, separating, p_separating):
+        try:
+            inferred = run_inference(file_hash + '/original.ogg', trace_id, stems, folder, quality, run)
+        except Exception:
+            scheduler.finish(ticket, measure=False)
+            raise
+        # previews run faster than the full runs the real-time factor estimates
+        scheduler.finish(ticket, measure=quality == 'full')
+    logger.info("Encoding inferenced stems...")
+    with job_stage(job, encoding, p_encoding):
+        if inferred.get('encoding'):
+            # the model server is encoding in the background
+            try:
+                wait_for_encode(folder, run)
+            finally:
+                clear_status(storage, folder, run)
+        else:
+            encode_resp = run_encode(BUCKET, inferred['object'], trace_id)
+            status = encode_resp['StatusCode']
+            # the invoke itself succeeds when the function raises, only FunctionError tells
+            if status != 200 or 'FunctionError' in encode_resp:
+                raise RuntimeError(f"Encoding {inferred['object']} failed: {encode_resp['Payload'].read()!r}")
+            storage.delete(inferred['object'])
+    if quality == 'full':
+        # the full stems are in, so the early chunks played meanwhile can go
+        clear_chunks(storage, run_folder(folder, run))
+    return status
 
 
-def s3_exists(obj):
+def run_preview(file_hash, stems, missing, ticket, job=None, trace_id=None):
+    """
+    Separates `missing` at preview quality, ahead of the full run's `ticket`
+    in line, and sets the job's preview. A failed preview only means waiting
+    for the full run.
+    """
+    folder = f'{file_hash}/{PREVIEW_FOLDER}'
     try:
-        s3_client.head_object(Bucket=BUCKET, Key=obj)
-    except ClientError:
-        logger.info(f"{obj} not found in cache")
-        return False
-    logger.info(f"{obj} found in cache")
-    return True
+        if missing_stems(folder, missing):
+            preview_ticket = scheduler.reserve(ticket.client, ticket.seconds * PREVIEW_COST, admit=False)
+            try:
+                separate(file_hash, missing, preview_ticket, job, trace_id, 'preview')
+            finally:
+                scheduler.finish(preview_ticket, measure=False)
+    except Exception:
+        logger.exception(f"Preview of {file_hash} failed")
+        return
+    if job:
+        urls = s3_presigned_urls(file_hash, [stem for stem in stems if stem not in missing], expires=600)
+        urls.update({stem: storage.url(f'{folder}/{stem}.ogg', expires=600) for stem in missing})
+        job.preview = {'stem_urls': urls}
+
+
+def clear_preview(file_hash, stems):
+    folder = f'{file_hash}/{PREVIEW_FOLDER}'
+    for stem in stems:
+        storage.delete(f'{folder}/{stem}.ogg')
 
 
-def s3_presigned_urls(folder):
+def s3_presigned_urls(folder, stems=SOURCES, expires=60):
     out_dict = {}
-    for obj in ['bass', 'drums', 'vocals', 'other', 'original']:
-        out_dict[obj] = s3_client.generate_presigned_url(
-            ClientMethod='get_object', 
-            Params={
-                'Bucket': BUCKET, 
-                'Key': folder + '/' + obj + '.ogg'}, 
-            ExpiresIn=60)
+    for obj in [*stems, 'original']:
+        out_dict[obj] = storage.url(folder + '/' + obj + '.ogg', expires=expires)
     return out_dict
 
 
-def run_inference(key):
-    """ship audio to model"""
-    logger.info(f"Running inference on {key}")
-    resp = requests.post(url="http://model:8080/predictions/demucs_quantized/1", json={'Bucket': BUCKET, 'Key': key})
+def progressive_urls(folder, run=None):
+    """Stem URLs of the windows already published while `run` is separating `folder`."""
+    published = run_folder(folder, run)
+    manifest = read_manifest(storage, published)
+    if manifest is None:
+        return []
+    chunks = []
+    for chunk in manifest['chunks']:
+        prefix = chunk_folder(published, chunk['index'])
+        urls = {obj: storage.url(f'{prefix}/{obj}.ogg', expires=600) for obj in manifest.get('stems', SOURCES)}
+        # played alongside the whole original
+        urls['original'] = storage.url(f'{folder}/original.ogg', expires=600)
+        chunks.append(dict(chunk, stem_urls=urls))
+    return chunks
+
+
+def run_inference(key, trace_id=None, stems=SOURCES, folder=None, quality='full', run=None):
+    """ship audio to model, results go to `folder` (default: the key's)"""
+    logger.info(f"Running {quality} inference on {key} for {stems}")
+    resp = requests.post(url="http://model:8080/predictions/demucs_quantized/1",
+                         json={'Bucket': BUCKET, 'Key': key, 'TraceId': trace_id, 'Stems': stems,
+                               'Folder': folder, 'Quality': quality, 'Run': run},
+                         headers={'X-Request-ID': trace_id or ''})
     if resp.status_code != 200:
         raise RuntimeError(f"Torchserve inference failed with HTTP {resp.status_code} | {resp.text}")
+    out = resp.json()
+    # a track failing on its own comes back in its slot of an otherwise fine batch
+    if 'error' in out:
+        raise RuntimeError(f"Torchserve inference failed | {out['error']}")
+    return out
+
+
+def wait_for_encode(folder, run=None, timeout=600, interval=1):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = read_status(storage, folder, run)
+        if status is not None:
+            if not status['ok']:
+                raise RuntimeError(f"Encoding failed: {status['error']}")
+            return
+        time.sleep(interval)
+    raise RuntimeError(f"Timed out waiting for {folder} to be encoded")
 
 
-def run_encode(bucket, obj):
+def run_encode(bucket, obj, trace_id=None):
     """
-    aws --debug --cli-read-timeout 0  lambda invoke --function-name test --payload '{"bucket": "demucs-app-cache", "object": "test/inferred.npz"}' out.json
+    aws --debug --cli-read-timeout 0  lambda invoke --function-name test --payload '{"bucket": "demucs-app-cache", "object": "test/model_output.stems"}' out.json
     """
-    payload = json.dumps({"bucket": bucket, "object": obj})
+    payload = json.dumps({"bucket": bucket, "object": obj, "trace_id": trace_id})
     logger.info("Invoking encode function on Lambda")
     ret  = lambda_client.invoke(FunctionName='audio-encode', InvocationType='RequestResponse', Payload=payload)
     return ret
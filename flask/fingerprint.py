@@ -0,0 +1,218 @@
+"""
+Audio fingerprints, so the same track uploaded as another container, codec or
+bitrate finds the stems already separated for it.
+
+A fingerprint is one 32-bit word per frame of the decoded, downmixed 11 kHz
+signal: bit m says whether the energy difference between bands m and m+1 grew
+since the previous frame (Haitsma & Kalker). Those signs survive lossy coding,
+so two encodings of a track differ in a few percent of bits while unrelated
+tracks differ in about half.
+
+Each track's fingerprint is stored on its own under `fingerprints/<file_hash>.npz`.
+Lookups go through an in-memory inverted index of anchor words, a content
+sampled subset of every track's words. As in Haitsma & Kalker, an upload's
+words are also looked up with their least reliable bits flipped, since few
+survive re-encoding exactly. Hits vote for (track, offset) pairs, and only the
+best few candidates are compared in full.
+"""
+import io
+import threading
+import time
+import numpy as np
+from loguru import logger
+
+RATE = 11025
+FRAME = 2048
+HOP = 256
+# frames transformed at once, bounding the FFT temporaries to a few MB
+BLOCK = 128
+# 33 bands between 300 Hz and 2 kHz, as FFT bin edges
+BINS = np.round(np.geomspace(300, 2000, 34) * FRAME / RATE).astype(int)
+# what ffmpeg decodes the upload to
+PCM_COMMAND = ['ffmpeg', '-loglevel', 'error', '-i', '-', '-ac', '1', '-ar', str(RATE), '-f', 's16le', '-']
+# bit error rate below which two fingerprints are the same track
+MAX_BER = 0.3
+# frames of misalignment tolerated between encodings, e.g. encoder delay
+MAX_SHIFT = 3
+FOLDER = 'fingerprints'
+# words whose hash has this many leading zero bits are anchors, 1 in 16. The same word
+# is an anchor in every track, so an exact word match between two encodings is found
+ANCHOR_BITS = 4
+# anchor words with more postings than this (silence, clipping) say nothing about a match
+MAX_POSTINGS = 64
+# least reliable bits of each query word tried flipped, in every combination
+FLIP_BITS = 6
+# a candidate needs this many anchors agreeing on its offset to be compared in full
+MIN_VOTES = 2
+CANDIDATES = 3
+# two encodings of one track are at most this far apart in duration and alignment
+MAX_SECONDS_APART = 1.5
+
+
+class Fingerprinter:
+    """
+    File-like sink for the s16le mono PCM of `PCM_COMMAND`: band energies are
+    computed frame by frame as data arrives, so memory doesn't grow with the
+    track beyond one row of energies per frame.
+    """
+    def __init__(self):
+        self.window = np.hanning(FRAME)
+        self.pending = b''
+        self.samples = np.zeros(0)
+        self.rows = []
+        self.length = 0
+
+    def write(self, data):
+        data = self.pending + bytes(data)
+        usable = len(data) - len(data) % 2
+        self.pending = data[usable:]
+        chunk = np.frombuffer(data[:usable], '<i2') / 2**15
+        self.length += len(chunk)
+        self.samples = np.concatenate([self.samples, chunk])
+        count = (len(self.samples) - FRAME) // HOP + 1
+        if count > 0:
+            frames = np.lib.stride_tricks.sliding_window_view(self.samples, FRAME)[::HOP][:count]
+            for start in range(0, count, BLOCK):
+                power = np.abs(np.fft.rfft(frames[start:start + BLOCK] * self.window, axis=1)) ** 2
+                self.rows.append(np.add.reduceat(power[:, BINS[0]:BINS[-1]], BINS[:-1] - BINS[0], axis=1))
+            self.samples = self.samples[count * HOP:]
+        return len(data)
+
+    def result(self):
+        """
+        (words, weak, seconds): one uint32 per frame, the FLIP_BITS bits of
+        each word closest to flipping, and the decoded duration.
+        """
+        energy = np.concatenate(self.rows) if self.rows else np.zeros((0, len(BINS) - 1))
+        diff = energy[:, :-1] - energy[:, 1:]
+        delta = diff[1:] - diff[:-1]
+        words = np.packbits(delta > 0, axis=1, bitorder='little').view('<u4').ravel()
+        weak = np.argsort(np.abs(delta), axis=1)[:, :FLIP_BITS]
+        return words, weak, self.length / RATE
+
+
+def bit_error_rate(a, b, max_shift=MAX_SHIFT):
+    """Fraction of differing bits between `a` and `b` at their best alignment."""
+    best = 1.
+    for shift in range(-max_shift, max_shift + 1):
+        x, y = (a[shift:], b) if shift >= 0 else (a, b[-shift:])
+        n = min(len(x), len(y))
+        if n == 0:
+            continue
+        errors = np.unpackbits(np.bitwise_xor(x[:n], y[:n]).view(np.uint8)).sum()
+        best = min(best, errors / (32 * n))
+    return best
+
+
+def flipped(words, weak):
+    """(variants, positions): every word of `words` with each combination of its `weak` bits flipped."""
+    combos = ((np.arange(1 << weak.shape[1])[:, None] >> np.arange(weak.shape[1])) & 1).astype(np.uint64)
+    masks = (combos[None] << weak[:, None, :].astype(np.uint64)).sum(axis=-1)
+    variants = (words[:, None] ^ masks).astype(np.uint32)
+    positions = np.broadcast_to(np.arange(len(words))[:, None], variants.shape)
+    return variants.ravel(), positions.ravel()
+
+
+def anchors(words):
+    """Positions of the anchor words in `words`."""
+    hashed = (words.astype(np.uint64) * 0x9E3779B1) & 0xFFFFFFFF
+    picked = (hashed >> (32 - ANCHOR_BITS) == 0) & (words != 0) & (words != 0xFFFFFFFF)
+    return np.flatnonzero(picked)
+
+
+class Index:
+    """
+    Anchor words of every fingerprint in `storage`, sorted for lookups by
+    binary search. Fingerprints recorded by other processes are picked up by
+    listing the folder at most every `refresh` seconds.
+    """
+    def __init__(self, storage, refresh=60):
+        self.storage = storage
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.hashes, self.seconds = [], []  # by track number
+        self.indexed = set()
+        self.words = np.zeros(0, np.uint32)
+        self.tracks = np.zeros(0, np.int32)
+        self.positions = np.zeros(0, np.int32)
+        self.pending = []
+        self.synced = 0.
+
+    def _key(self, file_hash):
+        return f'{FOLDER}/{file_hash}.npz'
+
+    def _load(self, file_hash):
+        with self.storage.open(self._key(file_hash)) as f:
+            saved = np.load(io.BytesIO(f.read()))
+            return saved['words'], float(saved['seconds'])
+
+    def _add(self, file_hash, words, seconds):
+        if file_hash in self.indexed:
+            return
+        picked = anchors(words)
+        self.pending.append((words[picked], np.full(len(picked), len(self.hashes), np.int32), picked.astype(np.int32)))
+        self.hashes.append(file_hash)
+        self.seconds.append(seconds)
+        self.indexed.add(file_hash)
+
+    def _sync(self):
+        if time.time() - self.synced > self.refresh:
+            self.synced = time.time()
+            for key in self.storage.list(FOLDER):
+                file_hash = key[len(FOLDER) + 1:-len('.npz')]
+                if key.endswith('.npz') and file_hash not in self.indexed:
+                    try:
+                        self._add(file_hash, *self._load(file_hash))
+                    except Exception:
+                        logger.exception(f"Skipping unreadable fingerprint {key}")
+        if self.pending:
+            merged = [np.concatenate(arrays) for arrays in zip((self.words, self.tracks, self.positions), *self.pending)]
+            order = np.argsort(merged[0], kind='stable')
+            self.words, self.tracks, self.positions = (array[order] for array in merged)
+            self.pending = []
+
+    def _candidates(self, words, weak):
+        """(track, offset) pairs most anchors of `words` agree on, best first."""
+        variants, positions = flipped(words, weak)
+        picked = anchors(variants)
+        query, picked = variants[picked], positions[picked]
+        lo = np.searchsorted(self.words, query, 'left')
+        hi = np.searchsorted(self.words, query, 'right')
+        counts = hi - lo
+        counts[counts > MAX_POSTINGS] = 0
+        if not counts.sum():
+            return []
+        # every posting of every anchor, flattened
+        ends = np.cumsum(counts)
+        hits = np.arange(ends[-1]) - np.repeat(ends - counts, counts) + np.repeat(lo, counts)
+        offsets = np.repeat(picked, counts) - self.positions[hits]
+        pairs, votes = np.unique(np.stack([self.tracks[hits], offsets], axis=1), axis=0, return_counts=True)
+        best = np.argsort(-votes)[:CANDIDATES]
+        return [(int(track), int(offset)) for track, offset in pairs[best][votes[best] >= MIN_VOTES]]
+
+    def find_match(self, words, weak, seconds):
+        """file_hash of an indexed track that sounds like `words`, or None."""
+        with self.lock:
+            self._sync()
+            candidates = [(self.hashes[track], self.seconds[track], offset)
+                          for track, offset in self._candidates(words, weak)]
+        best, match = MAX_BER, None
+        for file_hash, their_seconds, offset in candidates:
+            if abs(their_seconds - seconds) > MAX_SECONDS_APART or abs(offset) * HOP / RATE > MAX_SECONDS_APART:
+                continue
+            theirs, _ = self._load(file_hash)
+            ber = bit_error_rate(words[offset:], theirs) if offset >= 0 else bit_error_rate(words, theirs[-offset:])
+            if ber < best:
+                best, match = ber, file_hash
+        if match:
+            logger.info(f"Fingerprint matches {match} (bit error rate {best:.3f})")
+        return match
+
+    def record(self, words, seconds, file_hash):
+        """Stores the fingerprint of `file_hash` and indexes it."""
+        buf = io.BytesIO()
+        np.savez(buf, words=words.astype(np.uint32), seconds=seconds)
+        buf.seek(0)
+        self.storage.put(self._key(file_hash), buf)
+        with self.lock:
+            self._add(file_hash, words, seconds)
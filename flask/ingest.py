@@ -0,0 +1,103 @@
+"""
+Tracks separated from a pasted link rather than an upload.
+
+A downloader turns a link into a source ID, e.g. a YouTube video ID, tells
+its duration without downloading it, and downloads that source's audio into
+a directory. Each separated source is
+indexed in storage under `sources/<kind>/<id>.json` with the cache folder
+its stems are in and its duration, so a repeat link skips the download.
+
+`open_downloader()` picks the downloader from DEMUXR_DOWNLOADER:
+    youtube         youtube_dl (default)
+    local:<dir>     links `local:<name>` "download" <dir>/<name>, for tests
+"""
+import io
+import json
+import os
+import re
+import shutil
+from loguru import logger
+
+YOUTUBE_ID = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/|v/)|youtu\.be/)([\w-]{11})')
+
+
+class YoutubeDownloader:
+    kind = 'youtube'
+
+    def source_id(self, url):
+        match = YOUTUBE_ID.search(url)
+        return match.group(1) if match else None
+
+    def _extract(self, source_id, download, dest=None):
+        import youtube_dl
+
+        opts = {
+            'quiet': True,
+            'noplaylist': True,
+            'socket_timeout': 30,
+            'format': 'bestaudio/best',
+            'outtmpl': os.path.join(dest or '.', '%(id)s.%(ext)s'),
+        }
+        with youtube_dl.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(f'https://www.youtube.com/watch?v={source_id}', download=download)
+            return info, ydl.prepare_filename(info)
+
+    def probe(self, source_id):
+        """Duration in seconds, from the video's metadata."""
+        info, _ = self._extract(source_id, download=False)
+        return float(info['duration'])
+
+    def download(self, source_id, dest):
+        """Downloads the best audio stream as is into `dest` and returns its path; conversion is up to the caller."""
+        _, path = self._extract(source_id, download=True, dest=dest)
+        return path
+
+
+class LocalDownloader:
+    kind = 'local'
+
+    def __init__(self, root):
+        self.root = root
+
+    def source_id(self, url):
+        if not url.startswith('local:'):
+            return None
+        name = url[len('local:'):]
+        return name if name and os.path.basename(name) == name and name not in ('.', '..') else None
+
+    def probe(self, source_id):
+        # guessed from the size at 128 kbit/s
+        return os.path.getsize(os.path.join(self.root, source_id)) / 16000
+
+    def download(self, source_id, dest):
+        path = os.path.join(dest, source_id)
+        shutil.copyfile(os.path.join(self.root, source_id), path)
+        return path
+
+
+def open_downloader(spec=None):
+    spec = spec or os.environ.get('DEMUXR_DOWNLOADER', 'youtube')
+    if spec == 'youtube':
+        return YoutubeDownloader()
+    if spec.startswith('local:'):
+        return LocalDownloader(spec[len('local:'):])
+    raise ValueError(f"Unknown downloader {spec!r}")
+
+
+def _source_key(kind, source_id):
+    return f'sources/{kind}/{source_id}.json'
+
+
+def lookup(storage, kind, source_id):
+    """The index entry of a source, {'file_hash': ..., 'seconds': ...}, or None."""
+    key = _source_key(kind, source_id)
+    if not storage.exists(key):
+        return None
+    with storage.open(key) as f:
+        return json.loads(f.read())
+
+
+def record(storage, kind, source_id, file_hash, seconds):
+    logger.info(f"Indexing {kind} source {source_id} as {file_hash}")
+    entry = json.dumps({'file_hash': file_hash, 'seconds': seconds}).encode()
+    storage.put(_source_key(kind, source_id), io.BytesIO(entry))
@@ -0,0 +1,104 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from metrics import QUEUE_WAIT, JOBS
+
+
+class Job:
+    def __init__(self, trace_id=None):
+        self.id = uuid.uuid4().hex
+        self.trace_id = trace_id or self.id
+        self.stage = 'queued'
+        self.progress = 0.
+        self.result = None
+        self.error = None
+        self.folder = None
+        self.run = None  # names the full run's own objects in the folder, e.g. its chunks
+        self.ticket = None  # scheduler.Ticket while the job needs the model
+        self.preview = None  # stem URLs of the quick first run, until the full one is done
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    def update(self, stage, progress=None):
+        logger.info(f"Job {self.id}: {stage}")
+        self.stage = stage
+        if progress is not None:
+            self.progress = progress
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'stage': self.stage,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    """
+    Runs jobs on a bounded thread pool so request threads only submit and poll.
+    Finished jobs are kept around for `ttl` seconds for clients to collect.
+
+    Jobs submitted with a `key` are coalesced: while a job for that key is in
+    flight, submitting the same key returns the running job instead of
+    starting another one. `fields` are set on a new job before it runs.
+    """
+    def __init__(self, max_workers=4, ttl=3600):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.ttl = ttl
+        self.jobs = {}
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, key=None, trace_id=None, **fields):
+        with self.lock:
+            self._evict()
+            if key is not None and key in self.inflight:
+                job = self.inflight[key]
+                logger.info(f"Coalescing {key} into job {job.id}")
+                return job
+            job = Job(trace_id)
+            for name, value in fields.items():
+                setattr(job, name, value)
+            self.jobs[job.id] = job
+            if key is not None:
+                self.inflight[key] = job
+        self.executor.submit(self._run, job, fn, args, key)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def running(self, key):
+        """The job in flight for `key`, which submitting it would return."""
+        with self.lock:
+            return self.inflight.get(key)
+
+    def _run(self, job, fn, args, key):
+        QUEUE_WAIT.observe(time.time() - job.created)
+        try:
+            with logger.contextualize(trace_id=job.trace_id):
+                job.result = fn(job, *args)
+                job.update('done', 1.)
+            JOBS.labels('done').inc()
+        except Exception as e:
+            logger.exception(f"Job {job.id} failed")
+            job.error = str(e)
+            job.update('failed')
+            JOBS.labels('failed').inc()
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                self.inflight.pop(key, None)
+            job.done.set()
+
+    def _evict(self):
+        now = time.time()
+        expired = [k for k, j in self.jobs.items() if j.finished and now - j.finished > self.ttl]
+        for k in expired:
+            del self.jobs[k]
@@ -0,0 +1,11 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+STAGE_SECONDS = Histogram('demuxr_stage_seconds', "Wall time of each pipeline stage", ['stage'],
+                          buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200))
+QUEUE_WAIT = Histogram('demuxr_queue_wait_seconds', "Time a job waits for a worker thread",
+                       buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+CACHE_LOOKUPS = Counter('demuxr_cache_lookups_total', "Cache lookups by result", ['result'])
+BYTES = Counter('demuxr_bytes_total', "Bytes moved to storage", ['kind'])
+JOBS = Counter('demuxr_jobs_total', "Finished jobs by outcome", ['outcome'])
+BACKLOG_SECONDS = Gauge('demuxr_backlog_seconds', "Estimated model time of the jobs waiting for or in separation")
+ADMISSIONS = Counter('demuxr_admissions_total', "Separation requests admitted or turned away", ['result'])
@@ -0,0 +1,127 @@
+import threading
+import time
+from loguru import logger
+from metrics import BACKLOG_SECONDS, ADMISSIONS
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Separation backlog is full, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, client, seconds, cost):
+        self.client = client
+        self.seconds = seconds
+        self.cost = cost
+        self.created = time.time()
+        self.ready = False  # its job is in wait(), not still uploading or previewing
+        self.started = None
+        self.finished = False
+
+
+class Scheduler:
+    """
+    Decides which job sends its track to the model server next, `slots` at a
+    time, so the model server's own queue stays short and nothing times out
+    in it.
+
+    A job's cost is its duration times the measured real-time factor of the
+    model server (an EWMA over finished runs). Waiting jobs are served fair
+    share by client, the client that has used the least model time first,
+    and shortest job first within that, so one long upload or one busy client
+    doesn't hold everyone else up. A slot goes to the first job in that order
+    that is actually waiting for it, so jobs reserved ahead of time don't
+    hold up those ready to run. `reserve` refuses new work with `Overloaded`
+    once the estimated backlog exceeds `budget` seconds.
+    """
+    def __init__(self, slots=2, budget=1800, rtf=0.2, alpha=0.2):
+        self.slots = slots
+        self.budget = budget
+        self.rtf = rtf
+        self.alpha = alpha
+        self.waiting = []
+        self.running = []
+        self.served = {}  # client -> model seconds used while it has had jobs here
+        self.cond = threading.Condition()
+
+    def reserve(self, client, seconds, admit=True):
+        """Queues a job for `seconds` of audio. With `admit`, raises Overloaded if the backlog is full."""
+        with self.cond:
+            cost = seconds * self.rtf
+            backlog = self._backlog()
+            if admit and self.waiting and backlog + cost > self.budget:
+                ADMISSIONS.labels('rejected').inc()
+                raise Overloaded((backlog + cost - self.budget) / self.slots)
+            ADMISSIONS.labels('admitted').inc()
+            if client not in self.served:
+                # a returning client starts level with the others rather than ahead of them
+                self.served[client] = min(self.served.values(), default=0.)
+            ticket = Ticket(client, seconds, cost)
+            self.waiting.append(ticket)
+            BACKLOG_SECONDS.set(self._backlog())
+            return ticket
+
+    def update(self, ticket, seconds):
+        """Sets the duration of a ticket reserved before it was known, e.g. while its track downloads."""
+        with self.cond:
+            ticket.seconds = seconds
+            ticket.cost = seconds * self.rtf
+            BACKLOG_SECONDS.set(self._backlog())
+            self.cond.notify_all()
+
+    def wait(self, ticket):
+        """Blocks until `ticket` may run."""
+        with self.cond:
+            ticket.ready = True
+            while not (len(self.running) < self.slots and self._next() is ticket):
+                self.cond.wait()
+            self.waiting.remove(ticket)
+            self.running.append(ticket)
+            ticket.started = time.time()
+            self.served[ticket.client] += ticket.cost
+            self.cond.notify_all()  # the next in line may take another free slot
+            logger.info(f"Scheduled {ticket.seconds:.0f}s of audio for {ticket.client} "
+                        f"after {ticket.started - ticket.created:.1f}s")
+
+    def finish(self, ticket, measure=True):
+        """Frees the ticket's slot or place in line; with `measure`, folds its run into the real-time factor."""
+        with self.cond:
+            if ticket.finished:
+                return
+            ticket.finished = True
+            if ticket.started is None:
+                self.waiting.remove(ticket)
+            else:
+                self.running.remove(ticket)
+                if measure and ticket.seconds > 0:
+                    rtf = (time.time() - ticket.started) / ticket.seconds
+                    self.rtf = (1 - self.alpha) * self.rtf + self.alpha * rtf
+            if not any(t.client == ticket.client for t in self.waiting + self.running):
+                del self.served[ticket.client]
+            BACKLOG_SECONDS.set(self._backlog())
+            self.cond.notify_all()
+
+    def status(self, ticket):
+        """Queue position (0 once running) and estimated seconds until the job's separation is done."""
+        with self.cond:
+            now = time.time()
+            if ticket.started is not None:
+                return {'position': 0, 'eta': max(0., ticket.started + ticket.seconds * self.rtf - now)}
+            order = self._order()
+            position = order.index(ticket) + 1 if ticket in order else 0
+            ahead = sum(t.seconds for t in order[:position - 1]) * self.rtf + self._remaining(now)
+            return {'position': position, 'eta': ahead / self.slots + ticket.seconds * self.rtf}
+
+    def _order(self):
+        return sorted(self.waiting, key=lambda t: (self.served[t.client], t.seconds, t.created))
+
+    def _next(self):
+        return next((t for t in self._order() if t.ready), None)
+
+    def _remaining(self, now):
+        return sum(max(0., t.started + t.seconds * self.rtf - now) for t in self.running)
+
+    def _backlog(self):
+        return sum(t.seconds for t in self.waiting) * self.rtf + self._remaining(time.time())
@@ -12,35 +12,73 @@ import PlayCircleFilledIcon from '@material-ui/icons/PlayCircleFilled'
 import './App.css'
 
 const Button = styled(MuiButton)(spacing)
-const server_endpoint = "/flask/file_upload"
+const server_endpoint = "/flask/jobs"
+const link_endpoint = "/flask/links"
+const poll_interval = 2000
 
 function App () {
   const [outputUrls, setOutputUrls] = useState("")
   const [demuxRunning, setDemuxRunning] = useState(false)
   const [demuxComplete, setDemuxComplete] = useState(false)
+  const [queue, setQueue] = useState(null)
+  const [previewing, setPreviewing] = useState(false)
+  const previewShown = useRef(false)
 
 
   const resetStates = useCallback(() => {
     setDemuxRunning(false)
     setDemuxComplete(false)
+    setQueue(null)
+    setPreviewing(false)
+    previewShown.current = false
   })
 
 
-  const fetchInference = useCallback((server_endpoint, data) => {
-    return fetch(server_endpoint, data, 120000).then(response => response.json())
+  // play the quick preview stems while the full quality run goes on
+  const showPreview = useCallback((urls) => {
+    previewShown.current = true
+    setOutputUrls(urls)
+    setPreviewing(true)
+    setDemuxComplete(true)
   })
 
 
-  function runInference(data) {
+  const fetchInference = useCallback((endpoint, data) => {
+    return fetch(endpoint, data, 120000)
+      .then(response => {
+        if (response.status === 429) throw new Error('Too busy, try again in ' + response.headers.get('Retry-After') + 's')
+        return response.json()
+      })
+      .then(job => pollJob(server_endpoint + '/' + job.job_id))
+  })
+
+
+  const pollJob = useCallback((job_endpoint) => {
+    return new Promise(resolve => setTimeout(resolve, poll_interval))
+      .then(() => fetch(job_endpoint).then(response => response.json()))
+      .then(job => {
+        setQueue(job.queue || null)
+        if (job.preview && !previewShown.current) showPreview(job.preview.stem_urls)
+        // otherwise the first window published while the track is separated
+        else if (job.chunks && job.chunks.length && !previewShown.current) showPreview(job.chunks[0].stem_urls)
+        if (job.stage === 'done') return job.result
+        if (job.stage === 'failed') throw new Error('Job failed: ' + job.error)
+        return pollJob(job_endpoint)
+      })
+  })
+
+
+  function runInference(data, endpoint = server_endpoint) {
     if (data['file'] !== null) {
       resetStates() 
       setDemuxRunning(true)
 
-      fetchInference(server_endpoint, { method: 'POST', body: data })
+      fetchInference(endpoint, { method: 'POST', body: data })
         .then(response => {
           console.log(response)
           if (response.status === 200) {
             setOutputUrls(response.stem_urls)
+            setPreviewing(false)
             setDemuxRunning(false)
             setDemuxComplete(true)
           } else {
@@ -62,9 +100,12 @@ function App () {
           runInference={runInference}
           demuxRunning={demuxRunning}
           demuxComplete={demuxComplete}
+          queue={queue}
+          previewing={previewing}
           resetStates={resetStates}/>
         
-        <Player urls={outputUrls} demuxRunning={demuxRunning} demuxComplete={demuxComplete} />
+        {/* remounted to load the full quality stems over the preview */}
+        <Player key={previewing ? 'preview' : 'full'} urls={outputUrls} demuxRunning={demuxRunning} demuxComplete={demuxComplete} />
 
         <footer className="footer">
           <Typography variant="h6">
@@ -76,36 +117,56 @@ function App () {
   )
 }
 
-function UserInput ({ runInference, demuxRunning, demuxComplete, resetStates }) {
+function UserInput ({ runInference, demuxRunning, demuxComplete, queue, previewing, resetStates }) {
   const fileRef = useRef()
+  const linkRef = useRef('')
+  const previewRef = useRef(false)
 
+  // a pasted link wins over a picked file
   const handleSubmit = (e) => {
     e.preventDefault()
-    const file = fileRef.current
     const data = new FormData()
-    data.append('file', file)
-    runInference(data)
+    // a quick lower quality pass first costs extra model time, so only on request
+    if (previewRef.current) data.append('quality', 'preview')
+    if (linkRef.current) {
+      data.append('url', linkRef.current)
+      runInference(data, link_endpoint)
+    } else {
+      data.append('file', fileRef.current)
+      runInference(data)
+    }
   }
 
   return (
     <div className="user-input">
       <Typography className="prompt" variant="h3" align="center"> Demuxr </Typography>
+      <input type="text" className="search-bar" placeholder="Paste a YouTube link"
+      onChange={(e) => { linkRef.current = e.target.value.trim() }}/>
       <input type="file" accept="audio/*" className="search-bar" placeholder="Upload audio file"
       onChange={(e) => { fileRef.current = e.target.files[0] }}/>
+      <label>
+        <input type="checkbox" onChange={(e) => { previewRef.current = e.target.checked }}/> Quick preview first
+      </label>
 
       <div className="btn-go">
         <Button onClick={handleSubmit} px="45px" variant="contained" color="primary">Go</Button>
       </div>
-      <Status demuxRunning={demuxRunning} demuxComplete={demuxComplete} />
+      <Status demuxRunning={demuxRunning} demuxComplete={demuxComplete} queue={queue} previewing={previewing} />
     </div>
   )
 }
 
 
-function Status ({ demuxRunning, demuxComplete}) {
+function Status ({ demuxRunning, demuxComplete, queue, previewing }) {
   let elt = null
   if (demuxRunning) {
     elt = <LinearProgress color="secondary" variant="indeterminate" />
+    if (queue && queue.position > 0) {
+      const minutes = Math.max(1, Math.round(queue.eta / 60))
+      elt = (<div>{elt}<Typography color="secondary">#{queue.position} in line, about {minutes} min</Typography></div>)
+    } else if (previewing) {
+      elt = (<div>{elt}<Typography color="secondary">Playing a preview, full quality on its way</Typography></div>)
+    }
   } else if (demuxComplete) {
     elt = <Typography color="secondary">Ready to play!</Typography>
   }
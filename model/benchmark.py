@@ -0,0 +1,220 @@
+"""
+CPU benchmark of every pipeline stage on synthetic audio.
+
+    python benchmark.py --seconds 60 --batch-sizes 1,4,8 --overlaps 0.25,0.1 --segments 10,5 > bench.jsonl
+
+Each case runs in a forked child so its peak RSS is its own, and prints one
+JSON line: stage, params, wall seconds (best of --repeat), audio seconds,
+real-time factor (wall / audio), throughput (audio seconds per wall second)
+and peak RSS in MB. apply_model cases at a precision other than fp32, with
+--resample-once or with more than one of --shards also report the worst
+per-source SDR against the plain fp32 output. Shards split --threads between
+them; their processes' memory is not in the peak RSS. A case that takes longer
+than --timeout is killed and reported as an error, so e.g.
+
+    python benchmark.py --stages apply_model --batch-sizes 8 --shards 1,2 --seconds 10
+
+checks that a sharded run of the full-size model finishes and matches.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import torch
+
+from model import Demucs
+from utils import apply_model, apply_model_batched, quantize_int8, shard_pool, source_sdr
+from storage import FileStorage
+import stems as stemfile
+from encoder import encode_stems, ffmpeg_command
+
+SAMPLERATE = 44100
+SOURCE_NAMES = ["drums", "bass", "other", "vocals"]
+
+
+def synthetic_mix(seconds, channels=2, seed=0):
+    gen = torch.Generator().manual_seed(seed)
+    return 0.1 * torch.randn(channels, int(seconds * SAMPLERATE), generator=gen)
+
+
+def load_model(weights=None):
+    model = Demucs(SOURCE_NAMES)
+    if weights:
+        model.load_state_dict(torch.load(weights, map_location='cpu'))
+    return model.eval()
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def timed(fn, repeat):
+    """Runs setup-free `fn` once to warm up, then returns the best of `repeat` runs."""
+    fn()
+    best = float('inf')
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def case_forward(args, model, batch_size):
+    seg = model.segment_length // 4
+    inp = 0.1 * torch.randn(batch_size, 2, model.valid_length(seg))
+    def run():
+        with torch.no_grad():
+            model(inp)
+    return {'seconds': timed(run, args.repeat), 'audio_seconds': batch_size * seg / SAMPLERATE}
+
+
+def case_apply(args, model, batch_size, overlap, segment, precision, resample_once, shards):
+    mix = synthetic_mix(args.seconds)
+    segment = int(segment * SAMPLERATE)
+    target = quantize_int8(model) if precision == 'int8' else model
+    amp_dtype = torch.bfloat16 if precision == 'bf16' else None
+    pool = shard_pool(target, shards, max(1, args.threads // shards)) if shards > 1 else None
+    run = lambda: apply_model_batched(target, [mix], batch_size, overlap, segment=segment, amp_dtype=amp_dtype,
+                                      resample_once=resample_once, pool=pool, shards=shards)[0]
+    result = {'seconds': timed(run, args.repeat), 'audio_seconds': args.seconds}
+    if precision != 'fp32' or resample_once or shards > 1:
+        reference = apply_model(model, mix, batch_size, overlap, segment=segment)
+        result['sdr_vs_baseline'] = min(source_sdr(run(), reference).tolist())
+    return result
+
+
+def case_preprocess(args, model):
+    from handler import DemucsHandler
+    handler = DemucsHandler()
+    mix = synthetic_mix(args.seconds)
+    return {'seconds': timed(lambda: handler.preprocess(mix), args.repeat), 'audio_seconds': args.seconds}
+
+
+def case_postprocess(args, model):
+    from handler import DemucsHandler
+    handler = DemucsHandler()
+    out = synthetic_mix(args.seconds, channels=2 * len(SOURCE_NAMES)).view(len(SOURCE_NAMES), 2, -1)
+    return {'seconds': timed(lambda: handler.postprocess(out, SAMPLERATE), args.repeat), 'audio_seconds': args.seconds}
+
+
+def quantized_stems(seconds):
+    out = synthetic_mix(seconds, channels=2 * len(SOURCE_NAMES)).view(len(SOURCE_NAMES), 2, -1)
+    return [(s * 2**15).clamp_(-2**15, 2**15 - 1).short().numpy() for s in out]
+
+
+def case_cache(args, model):
+    stems = dict(zip(SOURCE_NAMES, quantized_stems(args.seconds)))
+    storage = FileStorage(tempfile.mkdtemp())
+    def run():
+        buf = stemfile.pack(stems, SAMPLERATE)
+        storage.put('bench/model_output.stems', stemfile.BufferReader(buf))
+    try:
+        return {'seconds': timed(run, args.repeat), 'audio_seconds': args.seconds}
+    finally:
+        shutil.rmtree(storage.root)
+
+
+def case_encode(args, model):
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError("ffmpeg not found")
+    buf = stemfile.pack(dict(zip(SOURCE_NAMES, quantized_stems(args.seconds))), SAMPLERATE)
+    reader = stemfile.StemReader.from_buffer(buf)
+    storage = FileStorage(tempfile.mkdtemp())
+    try:
+        run = lambda: encode_stems(reader, storage, 'bench', ffmpeg_command)
+        return {'seconds': timed(run, args.repeat), 'audio_seconds': args.seconds}
+    finally:
+        shutil.rmtree(storage.root)
+
+
+def run_case(conn, args, stage, fn, params):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = load_model(args.weights)
+    base = rss_mb()
+    try:
+        measured = fn(args, model, **params)
+        seconds, audio_seconds = measured['seconds'], measured['audio_seconds']
+        result = {
+            'stage': stage,
+            'params': params,
+            'threads': args.threads,
+            'rtf': seconds / audio_seconds,
+            'throughput': audio_seconds / seconds,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'base_rss_mb': base,
+            **measured,
+        }
+    except Exception as e:
+        result = {'stage': stage, 'params': params, 'error': str(e)}
+    conn.send(result)
+    conn.close()
+
+
+def cases(args):
+    for batch_size in args.batch_sizes:
+        yield 'forward', case_forward, {'batch_size': batch_size}
+    for precision in args.precisions:
+        for batch_size in args.batch_sizes:
+            for overlap in args.overlaps:
+                for segment in args.segments:
+                    for shards in args.shards:
+                        params = {'batch_size': batch_size, 'overlap': overlap, 'segment': segment,
+                                  'precision': precision, 'resample_once': args.resample_once, 'shards': shards}
+                        yield 'apply_model', case_apply, params
+    yield 'preprocess', case_preprocess, {}
+    yield 'postprocess', case_postprocess, {}
+    yield 'cache', case_cache, {}
+    yield 'encode', case_encode, {}
+
+
+def main(argv=None):
+    floats = lambda s: [float(x) for x in s.split(',')]
+    ints = lambda s: [int(x) for x in s.split(',')]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=30, help="length of the synthetic track")
+    parser.add_argument('--batch-sizes', type=ints, default=[1, 4, 8])
+    parser.add_argument('--overlaps', type=floats, default=[0.25])
+    parser.add_argument('--segments', type=floats, default=[10], help="segment lengths in seconds")
+    parser.add_argument('--precisions', type=lambda s: s.split(','), default=['fp32'], help="fp32, int8 and/or bf16")
+    parser.add_argument('--resample-once', action='store_true', help="resample whole tracks, not segments")
+    parser.add_argument('--shards', type=ints, default=[1], help="processes one track is split across")
+    parser.add_argument('--stages', type=lambda s: s.split(','), default=None,
+                        help="subset of forward,apply_model,preprocess,postprocess,cache,encode")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--timeout', type=float, default=3600, help="seconds a case may take")
+    parser.add_argument('--weights', default=None, help="state dict to load; random init otherwise")
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    ctx = multiprocessing.get_context('fork')
+    for stage, fn, params in cases(args):
+        if args.stages and stage not in args.stages:
+            continue
+        recv, send = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=run_case, args=(send, args, stage, fn, params))
+        proc.start()
+        send.close()
+        try:
+            if not recv.poll(args.timeout):
+                proc.kill()
+                raise TimeoutError
+            result = recv.recv()
+        except EOFError:
+            result = {'stage': stage, 'params': params, 'error': f"benchmark process died ({proc.exitcode})"}
+        except TimeoutError:
+            result = {'stage': stage, 'params': params, 'error': f"timed out after {args.timeout}s"}
+        proc.join()
+        args.output.write(json.dumps(result) + '\n')
+        args.output.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Exports Demucs as a TorchScript artifact traced for one segment shape, so a
+worker loads it straight from the archive instead of building the eager model
+and fetching weights at startup.
+
+    python export.py --weights demucs-e07c671f.th --output demucs.ts
+
+The handler serves any `.ts` serialized file through `load_traced`. A trace
+only runs on the device it was made on (`--device`, this machine's by default):
+frozen weights don't follow `.to()` and tensors made on the fly, e.g. the
+resampling filters, have the device baked in. Workers on another device trace
+again from the `--weights` checkpoint if the archive ships it. Segments
+always have `valid_length(segment)` samples, so the trace holds for every
+batch; only the batch dimension varies. Models that work at twice the sample
+rate also get `forward_upsampled` traced, for apply_model's `resample_once`.
+"""
+import argparse
+import io
+import json
+import os
+import torch
+
+META_NAME = 'demucs.json'
+
+
+class TracedDemucs(torch.nn.Module):
+    """A traced Demucs plus the attributes apply_model reads off the eager model."""
+    def __init__(self, module, meta):
+        super().__init__()
+        self.module = module
+        self.meta = meta
+        self.sources = meta['sources']
+        self.audio_channels = meta['audio_channels']
+        self.samplerate = meta['samplerate']
+        self.segment_length = meta['segment_length']
+        self.segment = meta['segment']
+        self.precision = meta['precision']
+        self.resample = meta.get('resample', False)  # not recorded by older exports
+        self.device = meta.get('device', 'cpu')
+
+    def valid_length(self, length, upsampled=False):
+        expected = 2 * self.segment if upsampled else self.segment
+        if length != expected:
+            raise ValueError(f"Model was traced for segments of {expected} samples, not {length}")
+        return self.meta['valid_length_upsampled' if upsampled else 'valid_length']
+
+    def forward(self, mix):
+        return self.module(mix)
+
+    def forward_upsampled(self, mix):
+        return self.module.forward_upsampled(mix)
+
+    def __reduce__(self):
+        # script modules don't pickle, e.g. into a shard_pool worker; send the serialized artifact instead
+        buf = io.BytesIO()
+        torch.jit.save(self.module, buf)
+        return _loads, (buf.getvalue(), self.meta)
+
+
+def _loads(data, meta):
+    return TracedDemucs(torch.jit.load(io.BytesIO(data), map_location=meta['device']), meta).eval()
+
+
+def trace(model, segment=None, precision='fp32', batch_size=8, device='cpu'):
+    device = torch.device(device)
+    model = model.to(device)
+    segment = segment or model.segment_length // 4
+    length = model.valid_length(segment)
+    inputs = {'forward': torch.zeros(batch_size, model.audio_channels, length, device=device)}
+    if model.resample:
+        upsampled_length = model.valid_length(2 * segment, upsampled=True)
+        inputs['forward_upsampled'] = torch.zeros(batch_size, model.audio_channels, upsampled_length, device=device)
+    with torch.no_grad():
+        module = torch.jit.trace_module(model, inputs, check_trace=False)
+        module = torch.jit.freeze(module, preserved_attrs=list(inputs))
+    meta = {
+        'sources': list(model.sources),
+        'audio_channels': model.audio_channels,
+        'samplerate': model.samplerate,
+        'segment_length': model.segment_length,
+        'segment': segment,
+        'valid_length': length,
+        'valid_length_upsampled': upsampled_length if model.resample else None,
+        'resample': model.resample,
+        'precision': precision,
+        'device': device.type,
+    }
+    return TracedDemucs(module, meta)
+
+
+def save_traced(model, path):
+    torch.jit.save(model.module, path, _extra_files={META_NAME: json.dumps(model.meta)})
+
+
+def load_traced(path, device='cpu'):
+    """Check the result's `device` before running it, see the module docstring."""
+    extra_files = {META_NAME: ''}
+    module = torch.jit.load(str(path), map_location=device, _extra_files=extra_files)
+    return TracedDemucs(module, json.loads(extra_files[META_NAME])).eval()
+
+
+def main(argv=None):
+    from handler import load_model, DEVICE, MAX_BATCH_SZ
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights', default=None, help="state dict to export; the hub checkpoint otherwise")
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'diffq', 'int8', 'bf16'],
+                        help="bf16 is applied at run time, so it exports fp32")
+    parser.add_argument('--segment', type=int, default=None, help="segment length in samples")
+    parser.add_argument('--device', default=DEVICE.type, help="device the workers run on (default: this machine's)")
+    parser.add_argument('--output', default='demucs.ts')
+    args = parser.parse_args(argv)
+
+    precision = 'fp32' if args.precision == 'bf16' else args.precision
+    model = trace(load_model(args.weights, precision), args.segment, precision, MAX_BATCH_SZ, args.device)
+    # ship this file next to the artifact and workers on another device trace it again from there
+    model.meta['weights'] = os.path.basename(args.weights) if args.weights else None
+    save_traced(model, args.output)
+
+
+if __name__ == '__main__':
+    main()
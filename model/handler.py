@@ -3,42 +3,283 @@ import torchaudio
 from ts.torch_handler.base_handler import BaseHandler
 from pathlib import Path
 from loguru import logger
-import io
-import boto3
+import os
 import time
-import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 # From https://github.com/facebookresearch/demucs/
 from model import Demucs
-from utils import apply_model
+from utils import apply_model_batched, load_quantized_state, quantize_int8, shard_pool, source_sdr
+from storage import open_storage
+import stems as stemfile
+from encoder import encode_stems, ffmpeg_command, write_status
+from progressive import chunk_folder, run_folder, write_manifest
+from export import load_traced, save_traced, trace as trace_model
 
-S3_CLIENT = boto3.client('s3')
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+MAX_BATCH_SZ = 8
+SOURCE_NAMES = stemfile.SOURCES
+# Encode stems to ogg in this process instead of leaving model_output.stems for the encode function
+ENCODE_INLINE = os.environ.get('DEMUXR_ENCODE_INLINE', '0') == '1'
+ENCODE_WORKERS = int(os.environ.get('DEMUXR_ENCODE_WORKERS', 2))
+# Publish encoded windows of this many seconds while the rest of the track is separated
+PROGRESSIVE = os.environ.get('DEMUXR_PROGRESSIVE', '0') == '1'
+PROGRESSIVE_SECONDS = float(os.environ.get('DEMUXR_PROGRESSIVE_SECONDS', 30))
+# fp32 | diffq (DiffQ-compressed weights) | int8 (dynamic quantization, CPU) | bf16 (CPU autocast)
+PRECISION = os.environ.get('DEMUXR_PRECISION', 'fp32')
+# Log the SDR of the selected precision against fp32 when the worker starts
+PRECISION_CHECK = os.environ.get('DEMUXR_PRECISION_CHECK', '0') == '1'
+# Upsample each track once before segmenting it instead of every segment inside the model
+RESAMPLE_ONCE = os.environ.get('DEMUXR_RESAMPLE_ONCE', '0') == '1'
+# Tracks of a batch downloaded and decoded at once, alongside inference
+READ_WORKERS = int(os.environ.get('DEMUXR_READ_WORKERS', 4))
+# Full batches pushed through the model before the worker reports ready
+WARMUP_RUNS = int(os.environ.get('DEMUXR_WARMUP_RUNS', 2))
+# Preview tier: overlap, segment seconds (eager models only, a traced model keeps its own) and whether a
+# model working at twice the sample rate runs at the track's rate instead, half the work for lower quality.
+# The flask app prices previews from the same variables, so set them alike in both containers
+PREVIEW_OVERLAP = float(os.environ.get('DEMUXR_PREVIEW_OVERLAP', 0.1))
+PREVIEW_SEGMENT = float(os.environ.get('DEMUXR_PREVIEW_SEGMENT', 5))
+PREVIEW_NATIVE_RATE = os.environ.get('DEMUXR_PREVIEW_NATIVE_RATE', '1') == '1'
+QUALITIES = ('full', 'preview')
+# Split each track across this many worker processes (CPU only, 0 = off); the worker's threads are divided among them
+SHARDS = int(os.environ.get('DEMUXR_SHARDS', 0)) if DEVICE.type == 'cpu' else 0
+MODEL_URLS = {
+    'fp32': "https://dl.fbaipublicfiles.com/demucs/v3.0/demucs-e07c671f.th",
+    'diffq': "https://dl.fbaipublicfiles.com/demucs/v3.0/demucs_quantized-07afea75.th",
+}
 torchaudio.utils.sox_utils.set_buffer_size(8192 * 20)
 
 
-def read_ogg_from_s3(bucket, key):
-    response = S3_CLIENT.get_object(Bucket=bucket, Key=key)
-    waveform, samplerate = torchaudio.load(response['Body'], format='ogg')
+@contextmanager
+def timed(context, stage, trace):
+    """
+    Logs how long the block took and reports it as a `<Stage>Time` metric,
+    which TorchServe exports next to its own on the metrics address.
+    """
+    tic = time.time()
+    yield
+    elapsed = time.time() - tic
+    logger.info(f'{stage} took {elapsed} [trace {trace}]')
+    if getattr(context, 'metrics', None) is not None:
+        context.metrics.add_time(f'{stage.capitalize()}Time', elapsed * 1000, unit='ms')
+
+
+def add_counter(context, name, value):
+    if getattr(context, 'metrics', None) is not None:
+        context.metrics.add_counter(name, value)
+
+
+def read_ogg(bucket, key):
+    with open_storage(bucket).open(key) as body:
+        waveform, samplerate = torchaudio.load(body, format='ogg')
     return waveform, samplerate
 
  
-def load_model(model_weights_path):
+def load_model(model_weights_path, precision='fp32'):
+    if precision not in ('fp32', 'diffq', 'int8', 'bf16'):
+        raise ValueError(f"Unknown precision {precision}")
+    if model_weights_path is not None and Path(model_weights_path).suffix == '.ts':
+        # exported by export.py, quantization is baked in
+        model = load_traced(model_weights_path, DEVICE)
+        if model.precision != precision and not (precision == 'bf16' and model.precision == 'fp32'):
+            raise ValueError(f"{model_weights_path} was exported at {model.precision}, not {precision}; "
+                             f"export it with --precision {precision}")
+        if model.device != DEVICE.type:
+            # e.g. exported by a docker build without a GPU
+            model = retrace(model_weights_path, model)
+        return model
     if model_weights_path is None:
-        model_weights_url = "https://dl.fbaipublicfiles.com/demucs/v3.0/demucs-e07c671f.th"
+        model_weights_url = MODEL_URLS.get(precision, MODEL_URLS['fp32'])
         state = torch.hub.load_state_dict_from_url(model_weights_url, map_location='cpu', check_hash=True)
     else:
-        state = torch.load(model_weights_path)
+        state = torch.load(model_weights_path, map_location='cpu')
     model = Demucs(['bass', 'drums', 'vocals', 'other'])
-    model.load_state_dict(state)
+    if 'compressed' in state:
+        load_quantized_state(model, state)
+    elif precision == 'diffq':
+        raise ValueError("diffq precision needs DiffQ-compressed weights")
+    else:
+        model.load_state_dict(state)
     model.eval()
+    if precision == 'int8':
+        if DEVICE.type != 'cpu':
+            raise ValueError("int8 precision is CPU only")
+        model = quantize_int8(model)
+    return model
+
+
+def exported_weights(path, model):
+    """The checkpoint export.py traced `model` from, if the archive ships it next to `path`."""
+    name = model.meta.get('weights')
+    if name and (Path(path).parent / name).is_file():
+        return Path(path).parent / name
+    return None
+
+
+def retrace(path, model):
+    """
+    Traces the artifact at `path` again for DEVICE from the checkpoint it was
+    exported from, and keeps the result beside it so later workers load that.
+    """
+    path = Path(path)
+    device_path = path.with_suffix(f'.{DEVICE.type}.ts')
+    if device_path.is_file():
+        return load_traced(device_path, DEVICE)
+    weights = exported_weights(path, model)
+    if weights is None:
+        logger.warning(f"{path} was traced on {model.device} without its checkpoint, tracing the hub weights on {DEVICE}")
+    else:
+        logger.info(f"{path} was traced on {model.device}, tracing {weights.name} on {DEVICE}")
+    name = model.meta.get('weights')
+    model = trace_model(load_model(weights, model.precision), model.segment, model.precision, MAX_BATCH_SZ, DEVICE)
+    model.meta['weights'] = name
+    tmp = device_path.with_name(f'.{device_path.name}.{os.getpid()}')
+    try:
+        save_traced(model, tmp)
+        os.replace(tmp, device_path)
+    except OSError:
+        logger.exception(f"Couldn't keep the {DEVICE} trace at {device_path}")
     return model
 
 
+def amp_dtype(precision):
+    return torch.bfloat16 if precision == 'bf16' else None
+
+
+def model_segment(model):
+    """Segment length in samples: the traced one for exported models, the apply_model default otherwise."""
+    return getattr(model, 'segment', None) or model.segment_length // 4
+
+
+def separation_options(model, quality='full'):
+    """apply_model_batched keyword arguments for a quality tier."""
+    options = {'segment': model_segment(model), 'amp_dtype': amp_dtype(PRECISION), 'resample_once': RESAMPLE_ONCE}
+    if quality == 'preview':
+        options.update(overlap=PREVIEW_OVERLAP, native_rate=PREVIEW_NATIVE_RATE)
+        if getattr(model, 'segment', None) is None and PREVIEW_SEGMENT:
+            options['segment'] = int(PREVIEW_SEGMENT * model.samplerate)
+    return options
+
+
+def check_precision(model, reference, seconds=10):
+    """SDR in dB of `model` against the fp32 `reference` on a synthetic mix, per source."""
+    mix = 0.1 * torch.randn(2, int(seconds * reference.samplerate), generator=torch.Generator().manual_seed(0))
+    mix = mix.to(DEVICE)
+    segment = model_segment(model)
+    expected = apply_model_batched(reference, [mix], MAX_BATCH_SZ, segment=segment)[0]
+    actual = apply_model_batched(model, [mix], MAX_BATCH_SZ, segment=segment, amp_dtype=amp_dtype(PRECISION),
+                                 resample_once=RESAMPLE_ONCE)[0]
+    return source_sdr(actual, expected).tolist()
+
+
+def warmup(model, runs=WARMUP_RUNS, pool=None):
+    """
+    Separates silence in full batches, so allocator growth and TorchScript's
+    profiling runs happen before the worker takes traffic, not on the first
+    request. With a shard `pool`, that happens in its processes instead.
+    """
+    segment = model_segment(model)
+    mix = torch.zeros(2, int(0.75 * segment) * MAX_BATCH_SZ, device=DEVICE)
+    for _ in range(runs):
+        tic = time.time()
+        apply_model_batched(model, [mix], MAX_BATCH_SZ, segment=segment, amp_dtype=amp_dtype(PRECISION),
+                            resample_once=RESAMPLE_ONCE, pool=pool, shards=SHARDS)
+        logger.info(f"warmup batch took {time.time()-tic}")
+
+
+def host_buffer(size):
+    """Container memory the quantized stems are copied into: pinned on GPU hosts so the copy is a straight DMA."""
+    if DEVICE.type == 'cuda':
+        return torch.empty(size, dtype=torch.uint8, pin_memory=True).numpy()
+    return bytearray(size)
+
+
+def select_stems(sources, names):
+    """
+    (len(names), channels, length) output for the stems `names`, see
+    stems.mix_sources. The model output itself when all sources are asked for.
+    """
+    if list(names) == SOURCE_NAMES:
+        return sources
+    index = {source: i for i, source in enumerate(SOURCE_NAMES)}
+    return torch.stack([sources[[index[s] for s in stemfile.mix_sources(name, SOURCE_NAMES)]].sum(0)
+                        for name in names])
+
+
+def quantize_stems(sources, samplerate, normalize=True, names=SOURCE_NAMES):
+    """
+    Writes (stems, channels, length) float output as int16 straight into a
+    stems container holding `names` and returns its buffer. With `normalize`,
+    stems peaking above 1 are scaled down first, all peaks taken in one
+    reduction. Works in place on `sources`.
+    """
+    _, channels, length = sources.shape
+    buf, block = stemfile.allocate(names, channels, length, samplerate, host_buffer)
+    if normalize:
+        peak = sources.abs().amax(dim=(1, 2))
+        sources.div_(peak.mul_(1.01).clamp_(min=1)[:, None, None])
+    sources.mul_(2**15).clamp_(-2**15, 2**15 - 1)
+    # truncates like .short(); on GPU cast before the copy so half the bytes cross the bus
+    stems = sources.transpose(1, 2)
+    torch.from_numpy(block).copy_(stems if stems.device.type == 'cpu' else stems.to(torch.int16))
+    return buf
+
+
+class ChunkPublisher:
+    """
+    Encodes each finished window of a track as soon as the overlap-add has it
+    and lists it in the folder's chunk manifest. Chunks are only clamped, not
+    peak-normalized like postprocess does, since the track's peak isn't known yet.
+    """
+    def __init__(self, pool, s3_folder, samplerate, ref, stems=SOURCE_NAMES):
+        self.pool = pool  # single worker, so chunks land in the manifest in order
+        self.bucket, folder, run = s3_folder
+        self.folder = run_folder(folder, run)
+        self.stems = stems
+        self.samplerate = samplerate
+        self.mean, self.std = ref
+        self.chunk_len = int(PROGRESSIVE_SECONDS * samplerate)
+        self.published = 0
+        self.chunks = []
+        self.failed = False
+        write_manifest(open_storage(self.bucket), self.folder, [], complete=False, stems=stems)
+
+    def __call__(self, merger):
+        while self.published < merger.ready:
+            end = min(self.published + self.chunk_len, merger.ready)
+            last = end == merger.total_length
+            if end - self.published < self.chunk_len and not last:
+                break
+            chunk = select_stems(merger.take(self.published, end).mul_(self.std).add_(self.mean), self.stems)
+            buf = quantize_stems(chunk, self.samplerate, normalize=False, names=self.stems)
+            self.pool.submit(self.publish, buf, self.published, end, last)
+            self.published = end
+
+    def publish(self, buf, start, end, last):
+        if self.failed:
+            return
+        storage = open_storage(self.bucket)
+        index = len(self.chunks)
+        try:
+            encode_stems(stemfile.StemReader.from_buffer(buf), storage, chunk_folder(self.folder, index), ffmpeg_command)
+        except Exception:
+            logger.exception(f"Publishing chunk {index} of {self.folder} failed")
+            self.failed = True
+            return
+        self.chunks.append({'index': index, 'start': start / self.samplerate, 'duration': (end - start) / self.samplerate})
+        write_manifest(storage, self.folder, self.chunks, complete=last, stems=self.stems)
+
+
 
 class DemucsHandler(BaseHandler):
     def __init__(self):
         self.model = None
+        self.encode_pool = None
+        self.chunk_pool = None
+        self.shard_pool = None
         self.filedir = Path("filedir")
         self.filedir.mkdir(exist_ok=True)
 
@@ -52,83 +293,211 @@ class DemucsHandler(BaseHandler):
         self.manifest = ctx.manifest
         properties = ctx.system_properties
         model_weights_path = Path(properties.get("model_dir")) / Path(self.manifest['model']['serializedFile'])
-        self.model = load_model(model_weights_path).to(DEVICE)
+        self.model = load_model(model_weights_path, PRECISION).to(DEVICE)
+        if SHARDS > 1:
+            self.shard_pool = shard_pool(self.model, SHARDS)
+        if PRECISION_CHECK and PRECISION != 'fp32':
+            # DiffQ weights have no fp32 counterpart in the archive and a traced artifact has its precision
+            # baked in, so both compare against the checkpoint it was exported from or the hub one
+            if model_weights_path.suffix == '.ts':
+                fp32_weights = exported_weights(model_weights_path, self.model)
+            else:
+                fp32_weights = None if PRECISION == 'diffq' else model_weights_path
+            reference = load_model(fp32_weights).to(DEVICE)
+            logger.info(f"{PRECISION} SDR against fp32 per source: {check_precision(self.model, reference)}")
+            del reference
+        warmup(self.model, pool=self.shard_pool)
+        self.read_pool = ThreadPoolExecutor(READ_WORKERS, thread_name_prefix='read')
+        if ENCODE_INLINE:
+            self.encode_pool = ThreadPoolExecutor(ENCODE_WORKERS, thread_name_prefix='encode')
+            # at most this many separated tracks wait in memory for an encoder
+            self.encode_slots = threading.BoundedSemaphore(2 * ENCODE_WORKERS)
+        if PROGRESSIVE:
+            self.chunk_pool = ThreadPoolExecutor(1, thread_name_prefix='chunks')
+
 
+    def row_input(self, row):
+        inp = row.get('data') or row.get('body')
+        # results go next to the input unless the request names another folder, e.g. for previews.
+        # Objects only this run uses are named after its `Run`, so concurrent runs into one folder don't collide
+        s3_folder = (inp['Bucket'], inp.get('Folder') or inp['Key'].split('/')[0], inp.get('Run'))
+        # stems to store and encode, by default every source
+        stems = inp.get('Stems') or SOURCE_NAMES
+        # bad requests fail before the download
+        for name in stems:
+            stemfile.mix_sources(name, SOURCE_NAMES)
+        quality = inp.get('Quality', 'full')
+        if quality not in QUALITIES:
+            raise ValueError(f"Unknown quality {quality!r}")
+        return inp, s3_folder, inp.get('TraceId') or s3_folder[1], stems, quality
 
-    def read_input(self, data):
-        inp = data[0].get('data') or data[0].get('body') 
-        s3_folder = (inp['Bucket'], inp['Key'].split('/')[0])
-        wav, samplerate = read_ogg_from_s3(inp['Bucket'], inp['Key'])
-        wav = wav.to(DEVICE)
-        return wav, s3_folder, samplerate
+
+    def read_input(self, row, context=None):
+        inp, s3_folder, trace, stems, quality = self.row_input(row)
+        with timed(context, 'read', trace):
+            wav, samplerate = read_ogg(inp['Bucket'], inp['Key'])
+            wav = wav.to(DEVICE)
+        return wav, s3_folder, samplerate, trace, stems
         
 
     def preprocess(self, wav):
         """
         track: audio file
-        :return: tensor of normalized audio
+        :return: audio normalized in place, and the (mean, std) to undo it
         """
-        ref = wav.mean(0)
-        wav = (wav - ref.mean()) / ref.std()
+        mono = wav.mean(0)
+        ref = mono.mean(), mono.std()
+        wav.sub_(ref[0]).div_(ref[1])
         logger.info(f"Processed audio into tensor of size {wav.size()}")
         return wav, ref
 
 
-    def inference(self, wav, ref):
+    def inference(self, wavs, refs, on_merge=None, quality='full'):
+        """
+        Separates all tracks of a TorchServe batch together so their segments
+        share model batches. `wavs` may be a generator that appends each
+        track's entry to `refs` as it yields it.
+        """
         if self.model is None:
             raise RuntimeError("Model not initialized")
-        demuxed = apply_model(self.model, wav, 8)
-        demuxed = demuxed * ref.std() + ref.mean()
-        return demuxed
+        demuxed = apply_model_batched(self.model, wavs, MAX_BATCH_SZ, on_merge=on_merge, pool=self.shard_pool,
+                                      shards=SHARDS, **separation_options(self.model, quality))
+        return [d.mul_(std).add_(mean) for d, (mean, std) in zip(demuxed, refs)]
 
 
     # From https://github.com/facebookresearch/demucs/blob/dd7a77a0b2600d24168bbe7a40ef67f195586b62/demucs/separate.py#L207
-    def postprocess(self, inference_output):
+    def postprocess(self, inference_output, samplerate, stems=SOURCE_NAMES):
+        """Quantizes the requested `stems` of the separated track into the container cache() and encode() take."""
         logger.info("Starting postprocess")
-        stems = []
-        for source in inference_output:
-            source = source / max(1.01 * source.abs().max(), 1)  # source.max(dim=1).values.max(dim=-1)
-            source = (source * 2**15).clamp_(-2**15, 2**15 - 1).short()
-            source = source.cpu().numpy()
-            stems.append(source)
-        return stems
-
-
-    def cache(self, stems, s3_folder, samplerate, fmt=None):
-        bucket, folder = s3_folder
-        key = folder + '/model_output.npz'
-        source_names = ["drums", "bass", "other", "vocals"]
-        stems = dict(zip(source_names, stems))
-        stems['samplerate'] = samplerate
-        with io.BytesIO() as buf_:
-            np.savez_compressed(buf_, **stems)
-            buf_.seek(0)
-            S3_CLIENT.upload_fileobj(buf_, bucket, key)
+        return quantize_stems(select_stems(inference_output, stems), samplerate, names=stems)
+
+
+    def cache(self, buf, s3_folder):
+        bucket, folder, run = s3_folder
+        key = f'{folder}/model_output-{run}.stems' if run else f'{folder}/model_output.stems'
+        open_storage(bucket).put(key, stemfile.BufferReader(buf))
         return key
 
 
+    def encode(self, buf, s3_folder):
+        """
+        Encodes and uploads the stems on the encode pool and returns right away,
+        so the next batch's inference runs while this one is encoding.
+        """
+        bucket, folder, run_name = s3_folder
+        self.encode_slots.acquire()
+
+        def run():
+            storage = open_storage(bucket)
+            try:
+                tic = time.time()
+                encode_stems(stemfile.StemReader.from_buffer(buf), storage, folder, ffmpeg_command)
+                logger.info(f'encoding {folder} took {time.time()-tic}')
+                write_status(storage, folder, run=run_name)
+            except Exception as e:
+                logger.exception(f"Encoding {folder} failed")
+                write_status(storage, folder, error=str(e), run=run_name)
+            finally:
+                self.encode_slots.release()
+
+        self.encode_pool.submit(run)
+
+
+
+    def failed(self, trace, error):
+        """Response for a track that failed, so the rest of its batch still goes through."""
+        logger.opt(exception=error).error(f"Track {trace} failed")
+        return {"error": f"{type(error).__name__}: {error}"}
+
 
     def handle(self, data, context):
-        logger.info("Reading input track")
-        wav, s3_folder, samplerate = self.read_input(data)
+        """
+        Downloads and decodes the batch's tracks on the read pool while the
+        model runs, see separate(). Tracks asking for a preview are separated
+        first and apart from the others, since they run with other settings.
+        A track that can't be read or stored gets an error in its slot instead
+        of failing the batch.
+        """
+        logger.info(f"Reading {len(data)} input tracks")
+        results = [None] * len(data)  # TorchServe matches responses to requests by position
+        rows = {}
+        for index, row in enumerate(data):
+            try:
+                rows[index] = self.row_input(row)
+            except Exception as e:
+                results[index] = self.failed(index, e)
+        futures = {self.read_pool.submit(self.read_input, data[index], context): index for index in rows}
+        for quality in sorted({row[4] for row in rows.values()}, key=lambda quality: quality != 'preview'):
+            group = {future: index for future, index in futures.items() if rows[index][4] == quality}
+            trace = ','.join(rows[index][2] for index in group.values())
+            for index, result in self.separate(group, context, trace, quality):
+                results[index] = result
+        return results
 
-        tic = time.time()
-        wav, ref = self.preprocess(wav)
-        logger.info(f'preprocess took  {time.time()-tic}')
-        
-        tic = time.time()
-        out = self.inference(wav, ref)
-        logger.info(f'inference took  {time.time()-tic}')
-        
-        tic = time.time()
-        stems = self.postprocess(out)        
-        logger.info(f'postprocess took {time.time()-tic}')
-    
-        tic = time.time()
-        key = self.cache(stems, s3_folder, samplerate)
-        logger.info(f'caching took {time.time()-tic}')
 
-        result = {"bucket": s3_folder[0], "folder": s3_folder[1], "object": key}
+    def separate(self, futures, context, trace, quality='full'):
+        """
+        Each track is normalized and fed to inference as soon as its decode
+        future finishes, so decoding the next track overlaps separating this
+        one. A track is only fed whole since it is normalized by its own mean
+        and std. `futures` maps each decode to the track's index in the batch.
+        Returns (index, result) pairs.
+        """
+        # previews are quick enough as they are
+        progressive = self.chunk_pool is not None and quality != 'preview'
+        order, s3_folders, samplerates, traces, stem_sets, refs, publishers = [], [], [], [], [], [], []
+
+        def decoded():
+            # in completion order; the lists above grow alongside, indexed like apply_model's tracks
+            for future in as_completed(futures):
+                try:
+                    wav, s3_folder, samplerate, trace, stems = future.result()
+                    with timed(context, 'preprocess', trace):
+                        wav, ref = self.preprocess(wav)
+                except Exception as e:
+                    results.append((futures[future], self.failed(futures[future], e)))
+                    continue
+                add_counter(context, 'AudioSeconds', wav.shape[-1] / samplerate)
+                order.append(futures[future])
+                s3_folders.append(s3_folder)
+                samplerates.append(samplerate)
+                traces.append(trace)
+                stem_sets.append(stems)
+                refs.append(ref)
+                if progressive:
+                    publishers.append(ChunkPublisher(self.chunk_pool, s3_folder, samplerate, ref, stems))
+                yield wav
+
+        results = []
+        on_merge = None
+        if progressive:
+            on_merge = lambda track, merger: publishers[track](merger)
+
+        with timed(context, 'inference', trace):
+            outs = self.inference(decoded(), refs, on_merge, quality)
+        if progressive:
+            # every chunk is out before the response, so the caller can clear them once the full stems are in
+            self.chunk_pool.submit(lambda: None).result()
+        add_counter(context, 'Tracks', len(outs))
+
+        for index, out, s3_folder, samplerate, trace, stems in zip(order, outs, s3_folders, samplerates, traces,
+                                                                   stem_sets):
+            try:
+                with timed(context, 'postprocess', trace):
+                    buf = self.postprocess(out, samplerate, stems)
+
+                with timed(context, 'caching', trace):
+                    if self.encode_pool:
+                        key = None
+                        self.encode(buf, s3_folder)
+                    else:
+                        key = self.cache(buf, s3_folder)
+                        add_counter(context, 'BytesWritten', len(buf))
+            except Exception as e:
+                results.append((index, self.failed(trace, e)))
+                continue
 
-        return [result]
+            results.append((index, {"bucket": s3_folder[0], "folder": s3_folder[1], "object": key,
+                                     "encoding": key is None, "stems": stems}))
 
+        return results
@@ -142,7 +142,7 @@ class Demucs(nn.Module):
             rescale_module(self, reference=rescale)
 
     @torch.jit.export
-    def valid_length(self, length):
+    def valid_length(self, length: int, upsampled: bool = False) -> int:
         """
         Return the nearest valid length to use with the model so that
         there is no time steps left over in a convolutions, e.g. for all
@@ -154,8 +154,12 @@ class Demucs(nn.Module):
 
         For training, extracts should have a valid length.For evaluation
         on full tracks we recommend passing `pad = True` to :method:`forward`.
+
+        With `upsampled`, `length` is already at twice the sample rate, as fed
+        to :method:`forward_upsampled`, and so is the result.
         """
-        if self.resample:
+        resample = self.resample and not upsampled
+        if resample:
             length *= 2
         for _ in range(self.depth):
             length = math.ceil((length - self.kernel_size) / self.stride) + 1
@@ -164,11 +168,21 @@ class Demucs(nn.Module):
         for _ in range(self.depth):
             length = (length - 1) * self.stride + self.kernel_size
 
-        if self.resample:
+        if resample:
             length = math.ceil(length / 2)
         return int(length)
 
     def forward(self, mix):
+        return self._forward(mix, self.resample)
+
+    def forward_upsampled(self, mix):
+        """
+        Like :method:`forward` on a mix already upsampled x2, leaving the output
+        at that rate, so a whole track can be resampled once instead of every segment.
+        """
+        return self._forward(mix, False)
+
+    def _forward(self, mix, resample: bool):
         x = mix
 
         if self.normalize:
@@ -181,7 +195,7 @@ class Demucs(nn.Module):
 
         x = (x - mean) / (1e-5 + std)
 
-        if self.resample:
+        if resample:
             x = julius.resample_frac(x, 1, 2)
 
         saved = []
@@ -195,7 +209,7 @@ class Demucs(nn.Module):
             x = x + skip
             x = decode(x)
 
-        if self.resample:
+        if resample:
             x = julius.resample_frac(x, 2, 1)
         x = x * std + mean
         x = x.view(x.size(0), len(self.sources), self.audio_channels, x.size(-1))
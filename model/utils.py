@@ -1,8 +1,13 @@
 import torch
+import julius
 from diffq import DiffQuantizer
 import io
 import zlib
+import bisect
 import functools
+import itertools
+from multiprocessing.reduction import ForkingPickler
+from loguru import logger
     
 class TensorChunk:
     def __init__(self, tensor, offset=0, length=None):
@@ -70,67 +75,351 @@ def capture_init(init):
 
 
 
-# def load_model(model, model_weights_path, is_quantized=False):
-#     state = torch.load(model_weights_path)
-#     if is_quantized:
-#         quantizer = DiffQuantizer(model, group_size=8, min_size=1)
-#         buf = io.BytesIO(zlib.decompress(state["compressed"]))
-#         state = torch.load(buf, "cpu")
-#         quantizer.restore_quantized_state(state)
-#         quantizer.detach() 
-#     else:
-#         model.load_state_dict(state)
-#     model.eval()
-#     return model
-
-
-def apply_model(model, mix, max_batch_sz=None, overlap=0.25, transition_power=1.):
-    SEG_LEN = model.segment_length // 4
-    channels, total_length = mix.size()
-    device = mix.device
-    mix.unsqueeze_(0)
-    print("Mix size ", mix.size())
-
-    def merge_segments(out_segments, offsets):
-        out = torch.zeros(4, channels, total_length, device=device)
-        weight = torch.cat([torch.arange(1, SEG_LEN // 2 + 1), \
-            torch.arange(SEG_LEN - SEG_LEN // 2, 0, -1)]).to(device)
-        weight = (weight / weight.max())**transition_power
-        sum_weight = torch.zeros(total_length, device=device)
-        for i, out_seg in enumerate(out_segments):
-            offset = offsets[i]
-            end_ix = min(SEG_LEN, total_length - offset)
-            out[..., offset:offset + SEG_LEN] += (out_seg * weight)[..., :end_ix]
-            sum_weight[offset:offset + SEG_LEN] += weight[:end_ix]
-        out /= sum_weight
-        return out
-    
+def load_quantized_state(model, state):
+    """Restores DiffQ-compressed weights (the demucs `*_quantized` checkpoints) into `model`."""
+    quantizer = DiffQuantizer(model, group_size=8, min_size=1)
+    buf = io.BytesIO(zlib.decompress(state["compressed"]))
+    state = torch.load(buf, "cpu")
+    quantizer.restore_quantized_state(state)
+    quantizer.detach()
+    return model
 
-    def infer(inp, length):
-        with torch.no_grad(), torch.cuda.amp.autocast():
-            x = model(inp)
-            x.detach()
-            if length:
-                x = center_trim(x, length)
-        return x
-
-
-    def batch_infer(model, seg_list, out_length=None, batch_sz=None):
-        chunked_input = torch.vstack(seg_list)
-        batched_input = torch.split(chunked_input, batch_sz) if batch_sz else (chunked_input, )
-        chunked_output = torch.vstack([infer(inp, out_length) for inp in batched_input])
-        return chunked_output
-
-    seg_list = []
-    stride = int((1 - overlap) * SEG_LEN) 
-    offsets = range(0, total_length, stride)
-    valid_seg_len = model.valid_length(SEG_LEN)
-    
+
+def quantize_int8(model):
+    """
+    Dynamic int8 quantization of the LSTM and Linear layers (CPU only). The
+    convolutions stay in fp32, dynamic quantization has no kernels for them.
+    """
+    return torch.quantization.quantize_dynamic(model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+
+
+def source_sdr(estimate, reference, eps=1e-8):
+    """Per-source SDR in dB of `estimate` against `reference`, both (sources, channels, length)."""
+    signal = reference.pow(2).sum(dim=(1, 2))
+    noise = (estimate - reference).pow(2).sum(dim=(1, 2))
+    return 10 * torch.log10((signal + eps) / (noise + eps))
+
+
+@functools.lru_cache(maxsize=8)
+def crossfade_window(seg_len, transition_power, device):
+    weight = torch.cat([torch.arange(1, seg_len // 2 + 1), \
+        torch.arange(seg_len - seg_len // 2, 0, -1)]).to(device)
+    return (weight / weight.max())**transition_power
+
+
+@functools.lru_cache(maxsize=64)
+def plan_segments(total_length, seg_len, stride):
+    """
+    Offsets covering `total_length` samples with the fewest `seg_len` segments
+    at most `stride` apart. The last segment ends on the last sample instead of
+    running past it into padding, and the offsets are spread evenly so every
+    overlap is at least the requested one.
+    """
+    if total_length <= seg_len:
+        return (0,)
+    span = total_length - seg_len
+    count = -(-span // stride) + 1
+    return tuple(round(i * span / (count - 1)) for i in range(count))
+
+
+def padded_samples(total_length, offsets, seg_len, valid_seg_len):
+    """Zeros fed to the model for a track cut at `offsets`, see TensorChunk.padded."""
+    wasted = 0
     for offset in offsets:
-        seg =  TensorChunk(mix, offset, SEG_LEN).padded(valid_seg_len)
+        length = min(total_length - offset, seg_len)
+        start = offset - (valid_seg_len - length) // 2
+        wasted += max(0, -start) + max(0, start + valid_seg_len - total_length)
+    return wasted
+
+
+def overlap_norm(total_length, seg_len, offsets, transition_power, device):
+    """
+    Reciprocal of the summed crossfade weights over a track of `total_length`
+    cut into segments at `offsets`, i.e. what the overlap-added output gets
+    multiplied by.
+    """
+    window = crossfade_window(seg_len, transition_power, device)
+    offsets = torch.tensor(offsets, device=device)
+    index = (offsets[:, None] + torch.arange(seg_len, device=device)).flatten()
+    sum_weight = torch.zeros(total_length + seg_len, device=device)
+    sum_weight.index_add_(0, index, window.repeat(len(offsets)))
+    return 1 / sum_weight[:total_length]
+
+
+class OverlapAdd:
+    """
+    Crossfades batches of (batch, sources, channels, seg_len) model outputs
+    cut at `offsets` into a (sources, channels, total_length) track with one
+    scatter-add per batch.
+    """
+    def __init__(self, sources, channels, total_length, seg_len, offsets, transition_power=1., device=None):
+        self.total_length = total_length
+        self.seg_len = seg_len
+        self.offsets = tuple(offsets)
+        self.transition_power = transition_power
+        self.device = device
+        self.window = crossfade_window(seg_len, transition_power, device)
+        self.seg_index = torch.arange(seg_len, device=device)
+        # Padded by one segment so the tail of the last segments needs no clipping
+        self.out = torch.zeros(sources, channels, total_length + seg_len, device=device)
+        self.ready = 0
+        # Track-sized, so it lives and dies with the merger rather than in a cache
+        self._norm = None
+
+    def add(self, out_segments, offsets):
+        batch, sources, channels, seg_len = out_segments.shape
+        index = (torch.as_tensor(offsets, device=self.device)[:, None] + self.seg_index).flatten()
+        weighted = (out_segments * self.window).permute(1, 2, 0, 3).reshape(sources, channels, -1)
+        self.out.index_add_(-1, index, weighted.to(self.out.dtype))
+        # segments arrive in time order, so nothing later touches samples before the next offset
+        following = bisect.bisect_right(self.offsets, max(offsets))
+        ready = self.offsets[following] if following < len(self.offsets) else self.total_length
+        self.ready = max(self.ready, ready)
+
+    def norm(self):
+        if self._norm is None:
+            self._norm = overlap_norm(self.total_length, self.seg_len, self.offsets, self.transition_power,
+                                      self.device)
+        return self._norm
+
+    def take(self, start, end):
+        """Normalized copy of samples [start, end), which must be below `ready`."""
+        assert end <= self.ready
+        return self.out[..., start:end] * self.norm()[start:end]
+
+    def result(self):
+        return self.out[..., :self.total_length].mul_(self.norm())
+
+
+@functools.lru_cache(maxsize=8)
+def resampler(old_sr, new_sr, device):
+    """julius resampler with its filter built once per device."""
+    return julius.ResampleFrac(old_sr, new_sr).to(device)
+
+
+# Samples of context on each side of a window, at the upsampled rate, covering
+# the x2 downsampling filter (51 taps each side)
+RESAMPLE_MARGIN = 128
+
+
+class Downsampled:
+    """
+    Original-rate view of an OverlapAdd merging upsampled segments, for
+    `on_merge` consumers. Windows are downsampled with filter context on both
+    sides, so they match the downsampled track.
+    """
+    def __init__(self, merger):
+        self.merger = merger
+        self.total_length = merger.total_length // 2
+
+    @property
+    def ready(self):
+        if self.merger.ready == self.merger.total_length:
+            return self.total_length
+        return max(0, (self.merger.ready - RESAMPLE_MARGIN) // 2)
+
+    def take(self, start, end):
+        assert end <= self.ready
+        lo = max(0, 2 * start - RESAMPLE_MARGIN)
+        hi = min(self.merger.total_length, 2 * end + RESAMPLE_MARGIN)
+        out = resampler(2, 1, self.merger.device)(self.merger.take(lo, hi))
+        first = start - lo // 2
+        return out[..., first:first + end - start]
+
+
+def apply_model(model, mix, max_batch_sz=None, overlap=0.25, transition_power=1., segment=None, amp_dtype=None,
+                resample_once=False, native_rate=False):
+    """
+    Separate `mix` (channels, length) into (sources, channels, length).
+    """
+    return apply_model_batched(model, [mix], max_batch_sz, overlap, transition_power, segment=segment,
+                               amp_dtype=amp_dtype, resample_once=resample_once, native_rate=native_rate)[0]
+
+
+def _infer(forward, inp, length, amp_dtype):
+    dtype = amp_dtype
+    if dtype is None and inp.device.type == 'cuda':
+        dtype = torch.float16
+    with torch.no_grad(), torch.autocast(inp.device.type, dtype=dtype, enabled=dtype is not None):
+        x = forward(inp)
+        x.detach()
+        if length:
+            x = center_trim(x, length)
+    return x
+
+
+def _batched(segments, batch_sz):
+    keys, seg_list = [], []
+    for key, seg in segments:
+        keys.append(key)
         seg_list.append(seg)
-    
-    model_out = batch_infer(model, seg_list, SEG_LEN, max_batch_sz)
-    stems = merge_segments(model_out, offsets)
-    return stems
-    
\ No newline at end of file
+        if batch_sz and len(seg_list) == batch_sz:
+            yield keys, torch.vstack(seg_list)
+            keys, seg_list = [], []
+    if seg_list:
+        yield keys, torch.vstack(seg_list)
+
+
+# the model a shard_pool worker was started with
+_shard_model = None
+
+
+def _load_module(data):
+    return torch.load(io.BytesIO(data), weights_only=False)
+
+
+def _reduce_by_value(module):
+    buf = io.BytesIO()
+    torch.save(module, buf)
+    return _load_module, (buf.getvalue(),)
+
+
+# quantized tensors can't be moved to shared memory, so int8 layers are sent to shard workers as copies
+for _quantized in (torch.nn.quantized.dynamic.Linear, torch.nn.quantized.dynamic.LSTM):
+    ForkingPickler.register(_quantized, _reduce_by_value)
+
+
+def _shard_init(model, threads):
+    global _shard_model
+    _shard_model = model
+    torch.set_num_threads(threads)
+
+
+def shard_pool(model, processes, threads=None):
+    """
+    Worker processes for apply_model_batched's `pool`, each holding `model`.
+    They are spawned: a fork deadlocks on the first parallel op once torch's
+    OpenMP threads have started here, and building or loading a model starts
+    them. Eager weights are moved to shared memory so every worker maps the
+    same copy, except int8 layers; a traced model is sent whole to each.
+    `threads` per worker defaults to an even split of this process's.
+    """
+    threads = threads or max(1, torch.get_num_threads() // processes)
+    model.share_memory()
+    ctx = torch.multiprocessing.get_context('spawn')
+    return ctx.Pool(processes, initializer=_shard_init, initargs=(model, threads))
+
+
+def _separate_shard(mix, offsets, seg_len, valid_seg_len, max_batch_sz, transition_power, amp_dtype, direct):
+    """
+    Runs in a shard_pool worker: overlap-adds the segments of `mix` at
+    `offsets` without normalizing, over the span from the first offset to the
+    end of the last segment. Returns (first offset, span).
+    """
+    forward = _shard_model.forward_upsampled if direct else _shard_model
+    start = offsets[0]
+    local = [offset - start for offset in offsets]
+    span = local[-1] + seg_len
+    merger = OverlapAdd(len(_shard_model.sources), mix.shape[0], span, seg_len, local, transition_power, mix.device)
+    mix = mix.unsqueeze(0)
+    segments = ((offset, TensorChunk(mix, offset, seg_len).padded(valid_seg_len)) for offset in offsets)
+    for batch_offsets, batch in _batched(segments, max_batch_sz):
+        merger.add(_infer(forward, batch, seg_len, amp_dtype), [offset - start for offset in batch_offsets])
+    return start, merger.out[..., :span]
+
+
+def apply_model_batched(model, mixes, max_batch_sz=None, overlap=0.25, transition_power=1., on_merge=None, segment=None,
+                        amp_dtype=None, resample_once=False, native_rate=False, pool=None, shards=1):
+    """
+    Separate each of `mixes` (channels, length) into (sources, channels, length).
+    Segments of all tracks are cut lazily into one stream, inferred
+    `max_batch_sz` at a time and overlap-added into their track as soon as
+    they come back, so short tracks fill batches alongside long ones and peak
+    memory on top of the input and output tensors is a single batch.
+    Each track is cut by `plan_segments`, so no segment runs past its end.
+    `mixes` can be any iterable, e.g. a generator yielding tracks as they are
+    decoded; inference starts on the first one meanwhile.
+
+    `on_merge(track, merger)` is called after every merge into a track, e.g. to
+    publish the finished prefix `merger.take(..., merger.ready)` early.
+    `segment` overrides the segment length in samples (default: a quarter of
+    the training segment length). `amp_dtype` is the autocast dtype, e.g.
+    torch.bfloat16 on CPU; by default fp16 on CUDA and no autocast on CPU.
+
+    With `resample_once`, a model that works at twice the sample rate gets each
+    whole track upsampled once before it is cut and the merged output
+    downsampled once, instead of resampling every segment in and out. The
+    tracks and merge buffers are held at the doubled rate meanwhile.
+    With `native_rate`, such a model runs on the tracks at their own rate
+    instead, nothing resampled: each segment covers twice the audio, so there
+    are half as many, at a cost in quality that suits previews.
+
+    With a `pool` from `shard_pool`, each track's segment plan is instead split
+    into `shards` contiguous runs separated in the pool's processes at once,
+    so a single long track is done in about 1/shards of the time on as many
+    cores. Each worker returns the un-normalized overlap-add of its run and
+    the runs are summed into the track, which gives the same result as
+    separating it here. `on_merge` is then called once per track, when all its
+    shards are in.
+    """
+    SEG_LEN = segment or model.segment_length // 4
+    native = native_rate and model.resample
+    upsampled = resample_once and model.resample and not native
+    # segments go straight to the network, bypassing the model's own resampling
+    direct = upsampled or native
+    forward = model
+    if direct:
+        forward = model.forward_upsampled
+        SEG_LEN *= 2
+    stride = int((1 - overlap) * SEG_LEN)
+    valid_seg_len = model.valid_length(SEG_LEN, upsampled=True) if direct else model.valid_length(SEG_LEN)
+
+    mergers, views = [], []
+
+    def plan_track(mix):
+        if upsampled:
+            with torch.no_grad():
+                mix = resampler(1, 2, mix.device)(mix)
+        channels, total_length = mix.size()
+        offsets = plan_segments(total_length, SEG_LEN, stride)
+        wasted = padded_samples(total_length, offsets, SEG_LEN, valid_seg_len)
+        logger.info(f"Mix size {mix.size()}, {len(offsets)} segments, {wasted} padded samples "
+                    f"({wasted / (len(offsets) * valid_seg_len):.1%} of model input)")
+        merger = OverlapAdd(len(model.sources), channels, total_length, SEG_LEN, offsets, transition_power, mix.device)
+        mergers.append(merger)
+        views.append(Downsampled(merger) if upsampled else merger)
+        return mix, offsets
+
+    def track_segments(track, mix):
+        mix, offsets = plan_track(mix)
+        mix = mix.unsqueeze(0)
+        for offset in offsets:
+            yield (track, offset), TensorChunk(mix, offset, SEG_LEN).padded(valid_seg_len)
+
+    if pool is not None:
+        # every track's shards are queued as it arrives, then collected in order
+        pending = []
+        for mix in mixes:
+            mix, offsets = plan_track(mix)
+            mix.share_memory_()
+            size = -(-len(offsets) // shards)
+            runs = [offsets[i:i + size] for i in range(0, len(offsets), size)]
+            pending.append([pool.apply_async(_separate_shard, (mix, run, SEG_LEN, valid_seg_len, max_batch_sz,
+                                                               transition_power, amp_dtype, direct))
+                            for run in runs])
+        for track, results in enumerate(pending):
+            merger = mergers[track]
+            for result in results:
+                start, span = result.get()
+                merger.out[..., start:start + span.shape[-1]] += span
+            merger.ready = merger.total_length
+            if on_merge:
+                on_merge(track, views[track])
+    else:
+        # tracks are only pulled from `mixes` once the previous one is cut up
+        segments = itertools.chain.from_iterable(track_segments(i, mix) for i, mix in enumerate(mixes))
+
+        for keys, batch in _batched(segments, max_batch_sz):
+            out = _infer(forward, batch, SEG_LEN, amp_dtype)
+            # scatter each run of rows back to the track it was cut from
+            start = 0
+            for track, run in itertools.groupby(keys, key=lambda k: k[0]):
+                offsets = [offset for _, offset in run]
+                mergers[track].add(out[start:start + len(offsets)], offsets)
+                start += len(offsets)
+                if on_merge:
+                    on_merge(track, views[track])
+    if upsampled:
+        with torch.no_grad():
+            return [resampler(2, 1, merger.device)(merger.result()) for merger in mergers]
+    return [merger.result() for merger in mergers]